@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks of the pipeline on synthetic data, see readme.md.
+Run from the repository root: python -m benchmark.run
+"""
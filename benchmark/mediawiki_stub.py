@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the MediaWiki API and upload.wikimedia.org, answering the requests the spider
+makes: query with images / extracts / pageprops / imageinfo (with continuation, normalization
+of redirects and missing pages), wbgetentities, and image files, with configurable latency and
+throttling. Every page exists unless chosen as missing, deterministically from its title.
+Run alone with `python -m benchmark.mediawiki_stub [port]`, or started by benchmark.run
+"""
+
+from __future__ import annotations
+import sys, asyncio, random, threading, zlib
+from aiohttp import web
+
+port = 8765
+latency = 0.02  # mean seconds before each response
+throttle = 0.0  # probability of a 429 response; backoff makes timings much noisier
+redirect_ratio = 0.05
+missing_ratio = 0.02
+disambiguation_ratio = 0.02
+image_size = 50000  # bytes
+
+imlimit = 10  # images per page in one response, the rest after continuation
+max_images = 14  # images per page, besides a wiki icon
+icon = "File:Circle-information.svg"
+
+
+class MediaWikiStub:
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.stats = {"api": 0, "upload": 0, "throttled": 0, "upload_bytes": 0}
+
+    @staticmethod
+    def fraction(title: str, salt: str) -> float:
+        return zlib.crc32((salt + title).encode("utf8")) / 2**32
+
+    def image_count(self, title: str) -> int:
+        return int(self.fraction(title, "images") * (max_images + 1)) + 1  # with the icon
+
+    async def delay(self) -> web.Response | None:
+        if latency:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        if random.random() < throttle:
+            self.stats["throttled"] += 1
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        return None
+
+    def image_info(self, title: str, thumb_width: str | None) -> dict:
+        name = title[title.find(":") + 1 :].replace(" ", "_")
+        svg = name.endswith(".svg")
+        info = {
+            "url": f"{self.base_url}/upload/wikipedia/commons/{name}",
+            "descriptionurl": f"{self.base_url}/wiki/{name}",
+            "size": image_size,
+            "width": 2000 if svg else 1600,
+            "height": 2000 if svg else 1200,
+            "mime": "image/svg+xml" if svg else "image/jpeg",
+        }
+        if thumb_width:
+            thumb = f"thumb/{name}/{thumb_width}px-{name}"
+            info["thumburl"] = f"{self.base_url}/upload/wikipedia/commons/{thumb}"
+            info["thumbwidth"] = int(thumb_width)
+        return info
+
+    def page(self, title: str, props: list[str], query: dict) -> dict:
+        page = {"pageid": zlib.crc32(title.encode("utf8")), "ns": 0, "title": title}
+        if "extracts" in props:
+            page["extract"] = f"{title} is a synthetic entity.\nIt exists for benchmarking."
+        if "images" in props:
+            count = self.image_count(title) - 1
+            images = [{"ns": 6, "title": f"File:{title} {k}.jpg"} for k in range(count)]
+            images.append({"ns": 6, "title": icon})
+            start = imlimit if "imcontinue" in query else 0
+            page["images"] = images[start : start + imlimit]
+        disambiguation = self.fraction(title, "disambiguation") < disambiguation_ratio
+        if "pageprops" in props and disambiguation:
+            page["pageprops"] = {"disambiguation": ""}
+        return page
+
+    def query(self, query: dict) -> dict:
+        titles = query.get("titles", "").split("|")
+        props = query.get("prop", "").split("|")
+        pages, redirects = {}, []
+        more_images = False
+        for i, title in enumerate(titles):
+            if title.startswith("File:"):
+                info = self.image_info(title, query.get("iiurlwidth"))
+                # files on commons are "missing" locally but come with their info
+                page = {"ns": 6, "title": title, "missing": "", "imagerepository": "shared"}
+                pages[str(-1 - i)] = {**page, "imageinfo": [info]}
+                continue
+            if self.fraction(title, "missing") < missing_ratio:
+                pages[str(-1 - i)] = {"ns": 0, "title": title, "missing": ""}
+                continue
+            if "redirects" in query and self.fraction(title, "redirect") < redirect_ratio:
+                redirects.append({"from": title, "to": title + " (topic)"})
+                title += " (topic)"
+            page = self.page(title, props, query)
+            pages[str(page["pageid"])] = page
+            if "images" in props and "imcontinue" not in query:
+                more_images |= self.image_count(title) > imlimit
+        res = {"query": {"pages": pages}}
+        if redirects:
+            res["query"]["redirects"] = redirects
+        if more_images:
+            res["continue"] = {"imcontinue": "0|more", "continue": "||"}
+        else:
+            res["batchcomplete"] = ""
+        return res
+
+    async def api(self, request: web.Request) -> web.Response:
+        self.stats["api"] += 1
+        throttled = await self.delay()
+        if throttled is not None:
+            return throttled
+        query = request.query
+        if query.get("action") == "wbgetentities":
+            # missing titles have no other sitelink
+            qids = query["ids"].split("|")
+            entities = {qid: {"type": "item", "id": qid, "sitelinks": {}} for qid in qids}
+            return web.json_response({"entities": entities, "success": 1})
+        return web.json_response(self.query(query))
+
+    async def upload(self, request: web.Request) -> web.Response:
+        self.stats["upload"] += 1
+        throttled = await self.delay()
+        if throttled is not None:
+            return throttled
+        # distinct content per file, so that content addressing finds no false duplicates
+        seed = zlib.crc32(request.path.encode("utf8")).to_bytes(4, "little")
+        body = (seed * (image_size // 4 + 1))[: image_size]
+        self.stats["upload_bytes"] += len(body)
+        return web.Response(body=body, content_type="image/jpeg")
+
+    async def get_stats(self, _: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/w/api.php", self.api),
+                web.get("/upload/{path:.*}", self.upload),
+                web.get("/stats", self.get_stats),
+            ]
+        )
+        return app
+
+
+def serve_in_thread(stub_port: int = port) -> MediaWikiStub:
+    """
+    returns: the stub serving from a background thread, its stats updated as requests come
+    """
+    stub = MediaWikiStub(f"http://127.0.0.1:{stub_port}")
+    ready = threading.Event()
+    errors: list[Exception] = []
+
+    def _serve() -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(stub.app())
+        try:
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", stub_port).start())
+        except OSError as e:  # port in use
+            errors.append(e)
+            return
+        finally:
+            ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=_serve, daemon=True).start()
+    ready.wait()
+    if errors:
+        raise errors[0]
+    return stub
+
+
+def main():
+    stub_port = int(sys.argv[1]) if len(sys.argv) > 1 else port
+    stub = MediaWikiStub(f"http://127.0.0.1:{stub_port}")
+    web.run_app(stub.app(), host="127.0.0.1", port=stub_port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Run the stages of the pipeline on a synthetic corpus, against the local MediaWiki stub,
+and report their throughput and peak memory. Each stage runs in its own process, so that
+peak RSS is its own (and its workers').
+python -m benchmark.run [stage...] [-b baseline.json]: with a baseline (results of a previous
+run), exit with an error if a stage got slower by more than regression_tolerance
+"""
+
+from __future__ import annotations
+import os, sys, json, time, shutil, resource
+import multiprocessing as mp
+from typing import Callable
+from benchmark import synthetic, mediawiki_stub
+
+work_dir = "benchmark-work"
+num_entities = 100000
+num_mentions = 2000
+num_qids = 2000
+seed = 0
+num_process = 8
+stages = ["extractor", "candidates", "gen", "spider"]
+results_path = "benchmark-results.json"
+regression_tolerance = 0.2  # fraction of throughput that may be lost before failing
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepare_corpus() -> None:
+    """
+    generate the corpus unless the one in work_dir was made with the same settings
+    """
+    settings = [num_entities, num_mentions, num_qids, seed]
+    marker = os.path.join(work_dir, "corpus.json")
+    if os.path.exists(marker):
+        with open(marker, "r") as f:
+            if json.load(f) == settings:
+                return
+    print("Generating synthetic corpus...")
+    synthetic.write_corpus(work_dir, num_entities, num_mentions, num_qids, seed)
+    with open(marker, "w") as f:
+        json.dump(settings, f)
+
+
+def measure(prepare: Callable[[], None], run: Callable[[], float]) -> dict:
+    """
+    in a child process, prepare() untimed, then run() timed; run returns the number of items
+    returns: items, seconds, peak RSS in MB of the child and its workers
+    """
+    queue = mp.get_context("fork").Queue()
+
+    def _target() -> None:
+        os.chdir(work_dir)
+        prepare()
+        start = time.perf_counter()
+        items = run()
+        seconds = time.perf_counter() - start
+        peak = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        queue.put({"items": items, "seconds": seconds, "peak_rss_mb": peak / 1024})
+
+    process = mp.get_context("fork").Process(target=_target)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"benchmark process exited with code {process.exitcode}")
+    return queue.get()
+
+
+def remove(*paths: str) -> None:
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def bench_extractor() -> dict:
+    import extractor
+
+    def _prepare() -> None:
+        remove("extracted")
+        os.makedirs("extracted")
+        extractor.input_entity_filepath = "latest-all.json"
+        extractor.output_filepath = "extracted/qid-entity.tsv"
+        extractor.output_fields_filepath = "extracted/qid-fields.tsv"
+        extractor.shard_output_dir = "extracted/shards"
+        extractor.checkpoint_path = "extracted/checkpoint.jsonl"
+        extractor.num_process = num_process
+        sys.argv = ["extractor.py"]
+
+    def _run() -> float:
+        extractor.main()
+        return num_entities
+
+    return {"unit": "entities", **measure(_prepare, _run)}
+
+
+def bench_candidates() -> dict:
+    import candidates
+
+    def _prepare() -> None:
+        remove("candidates/candidates.tsv")
+        candidates.num_process = num_process
+        candidates.use_cache = False
+        candidates.output_format = "tsv"
+        _, entities, _ = candidates.load_entity_store()
+        candidates.load_ngram_index(entities)
+
+    def _run() -> float:
+        candidates.generate()
+        return num_mentions
+
+    return {"unit": "mentions", **measure(_prepare, _run)}
+
+
+def bench_gen() -> dict:
+    import gen
+
+    def _prepare() -> None:
+        remove(gen.output_path)
+        gen.num_process = num_process
+        gen.load_entity2qid_store()
+
+    def _run() -> float:
+        gen.main()
+        return num_mentions
+
+    return {"unit": "mentions", **measure(_prepare, _run)}
+
+
+def bench_spider() -> dict:
+    import spider, candidates
+
+    stub = mediawiki_stub.serve_in_thread()
+    requests_before = stub.stats["api"] + stub.stats["upload"]
+
+    def _prepare() -> None:
+        remove("spider")
+        os.makedirs("spider")
+        # the spider runs in its own directory, reading the entities of the corpus
+        candidates.qid_entity_path = os.path.abspath(candidates.qid_entity_path)
+        candidates.qid_fields_path = os.path.abspath(candidates.qid_fields_path)
+        candidates.entity_store_path = os.path.abspath(candidates.entity_store_path)
+        for name, value in list(vars(spider).items()):
+            if isinstance(value, str) and value.startswith("https://"):
+                for host in ["https://en.wikipedia.org", "https://www.wikidata.org"]:
+                    value = value.replace(host, stub.base_url)
+                setattr(spider, name, value)
+        spider.proxy = None
+        spider.host_concurrency = {"127.0.0.1": 64}
+        spider.qid_file_path = os.path.abspath("qids.txt")
+        os.chdir("spider")
+        sys.argv = ["spider.py"]
+
+    def _run() -> float:
+        spider.main()
+        return num_qids
+
+    res = measure(_prepare, _run)
+    requests = stub.stats["api"] + stub.stats["upload"] - requests_before
+    return {"unit": "qids", **res, "requests_per_second": requests / res["seconds"]}
+
+
+benchmarks = {
+    "extractor": bench_extractor,
+    "candidates": bench_candidates,
+    "gen": bench_gen,
+    "spider": bench_spider,
+}
+
+
+def main():
+    args = sys.argv[1:]
+    baseline = None
+    if "-b" in args:
+        i = args.index("-b")
+        with open(args[i + 1], "r") as f:
+            baseline = json.load(f)
+        args = args[:i] + args[i + 2 :]
+    sys.path.insert(0, repo_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    prepare_corpus()
+    results = {}
+    for stage in args or stages:
+        print(f"Benchmarking {stage}...")
+        res = benchmarks[stage]()
+        res["items_per_second"] = res["items"] / res["seconds"]
+        results[stage] = res
+    print(f"\n{'stage':<12}{'items':>10}{'seconds':>10}{'items/s':>12}{'req/s':>10}{'peak MB':>10}")
+    for stage, res in results.items():
+        requests = f"{res['requests_per_second']:.1f}" if "requests_per_second" in res else "-"
+        print(
+            f"{stage:<12}{res['items']:>10.0f}{res['seconds']:>10.2f}"
+            f"{res['items_per_second']:>12.1f}{requests:>10}{res['peak_rss_mb']:>10.1f}"
+        )
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    if baseline is None:
+        return
+    regressed = []
+    for stage, res in results.items():
+        if stage in baseline:
+            ratio = res["items_per_second"] / baseline[stage]["items_per_second"]
+            print(f"{stage}: {ratio:.2f}x baseline throughput")
+            if ratio < 1 - regression_tolerance:
+                regressed.append(stage)
+    if regressed:
+        sys.exit(f"regression in {', '.join(regressed)}")
+
+
+if __name__ == "__main__":
+    main()
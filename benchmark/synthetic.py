@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic corpora, reproducible from a seed: a Wikidata-style JSON dump, the files the
+extractor would make from it, and mentions with known answers, laid out like the real data
+"""
+
+from __future__ import annotations
+import os, json, random
+from typing import Iterator
+
+syllables = ["ka", "lo", "mi", "ren", "to", "sa", "vel", "dor", "an", "is", "que", "bra", "el"]
+name_words = 2, 4  # words per entity name
+no_enwiki_ratio = 0.2  # entities without an enwiki sitelink, skipped by the extractor
+image_ratio = 0.3  # entities with a P18 image
+mention_splits = ["train", "valid", "test"]
+
+
+def random_word(rng: random.Random) -> str:
+    return "".join(rng.choice(syllables) for _ in range(rng.randint(1, 3))).capitalize()
+
+
+def random_name(rng: random.Random) -> str:
+    return " ".join(random_word(rng) for _ in range(rng.randint(*name_words)))
+
+
+def random_entities(num_entities: int, seed: int) -> Iterator[dict]:
+    """
+    yield: entities in the format of the dump, qids Q1...
+    """
+    rng = random.Random(seed)
+    for i in range(1, num_entities + 1):
+        qid, name = f"Q{i}", random_name(rng)
+        entity = {
+            "type": "item",
+            "id": qid,
+            "labels": {"en": {"language": "en", "value": name}},
+            "aliases": {"en": [{"language": "en", "value": random_name(rng)}]},
+            "claims": {},
+            "sitelinks": {},
+        }
+        if rng.random() >= no_enwiki_ratio:
+            entity["sitelinks"]["enwiki"] = {"site": "enwiki", "title": name, "badges": []}
+        if rng.random() < image_ratio:
+            snak = {"snaktype": "value", "property": "P18", "datavalue": {"value": f"{name}.jpg"}}
+            entity["claims"]["P18"] = [{"mainsnak": snak, "type": "statement", "rank": "normal"}]
+        yield entity
+
+
+def write_dump(path: str, num_entities: int, seed: int) -> None:
+    """
+    one entity per line between '[' and ']', as published
+    """
+    with open(path, "w") as f:
+        f.write("[\n")
+        for i, entity in enumerate(random_entities(num_entities, seed)):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(entity, ensure_ascii=False))
+        f.write("\n]\n")
+
+
+def corrupt(name: str, rng: random.Random) -> str:
+    """
+    a mention of an entity as found in text: a word dropped, a typo or a change of case
+    """
+    words = name.split()
+    kind = rng.randrange(4)
+    if kind == 0 and len(words) > 1:
+        words.pop(rng.randrange(len(words)))
+    elif kind == 1:
+        i = rng.randrange(len(words))
+        j = rng.randrange(len(words[i]))
+        words[i] = words[i][:j] + rng.choice("aeiou") + words[i][j + 1 :]
+    elif kind == 2:
+        return name.lower()
+    return " ".join(words)
+
+
+def write_corpus(
+    dir: str, num_entities: int, num_mentions: int, num_qids: int, seed: int
+) -> None:
+    """
+    latest-all.json: the dump; entities/qid-entity.tsv and entities/qid-fields.tsv: what the
+    extractor makes of it; candidates/ne2qid.json: for gen.py; mentions/WIKIMEL_*.json:
+    mentions of random entities with their answers; qids.txt: qids for the spider
+    """
+    for sub in ["entities", "mentions", "candidates/top100"]:
+        os.makedirs(os.path.join(dir, sub), exist_ok=True)
+    write_dump(os.path.join(dir, "latest-all.json"), num_entities, seed)
+    titles = []
+    with open(os.path.join(dir, "entities/qid-entity.tsv"), "w") as qid_entity, open(
+        os.path.join(dir, "entities/qid-fields.tsv"), "w"
+    ) as qid_fields:
+        for entity in random_entities(num_entities, seed):
+            if "enwiki" not in entity["sitelinks"]:
+                continue
+            qid, title = entity["id"], entity["sitelinks"]["enwiki"]["title"]
+            label = entity["labels"]["en"]["value"]
+            aliases = [a["value"] for a in entity["aliases"]["en"]]
+            images = [c["mainsnak"]["datavalue"]["value"] for c in entity["claims"].get("P18", [])]
+            qid_entity.write(f"{qid}\t{title}\n")
+            fields = [qid, title, label, "|".join(aliases), "|".join(images)]
+            qid_fields.write("\t".join(fields) + "\n")
+            titles.append((qid, title))
+    with open(os.path.join(dir, "candidates/ne2qid.json"), "w") as f:
+        json.dump({title: qid for qid, title in titles}, f)
+    rng = random.Random(seed + 1)
+    for i, split in enumerate(mention_splits):
+        mentions = {}
+        for j in range(i * num_mentions // 3, (i + 1) * num_mentions // 3):
+            qid, title = rng.choice(titles)
+            mentions[f"{split}-{j}"] = {"mentions": corrupt(title, rng), "answer": qid}
+        with open(os.path.join(dir, f"mentions/WIKIMEL_{split}.json"), "w") as f:
+            json.dump(mentions, f)
+    with open(os.path.join(dir, "qids.txt"), "w") as f:
+        f.write("\n".join(qid for qid, _ in rng.sample(titles, min(num_qids, len(titles)))))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache: normalized mention -> ranked (qid, score) candidates,
+kept at the largest number of candidates ever computed for the mention
+"""
+
+from __future__ import annotations
+import sqlite3
+from typing import Tuple
+
+
+class CandidateCache:
+    def __init__(self, path: str, signature: str):
+        """
+        signature: description of the entities and scoring settings the results depend on;
+        the cache is emptied when it changes
+        """
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS candidates "
+            "(mention TEXT PRIMARY KEY, k INTEGER, qids TEXT, scores BLOB)"
+        )
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        if row is None or row[0] != signature:
+            self.db.execute("DELETE FROM candidates")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,))
+        self.db.commit()
+
+    def get(self, mention: str, k: int) -> list[Tuple[str, int]] | None:
+        """
+        return: top-k (qid, score), or None if fewer than k were computed for the mention
+        """
+        row = self.db.execute(
+            "SELECT k, qids, scores FROM candidates WHERE mention = ?", (mention,)
+        ).fetchone()
+        if row is None or row[0] < k:
+            return None
+        qids = row[1].split("\t") if row[1] else []
+        return list(zip(qids, row[2]))[:k]
+
+    def put(self, mention: str, k: int, ranked: list[Tuple[str, int]]) -> None:
+        self.db.execute(
+            "INSERT INTO candidates VALUES (?, ?, ?, ?) ON CONFLICT(mention) DO UPDATE SET "
+            "k = excluded.k, qids = excluded.qids, scores = excluded.scores "
+            "WHERE excluded.k > candidates.k",
+            (mention, k, "\t".join(q for q, _ in ranked), bytes(s for _, s in ranked)),
+        )
+
+    def commit(self) -> None:
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary candidate output: per mention a fixed-width row of integer qids (Q123 -> 123,
+0 for padding) and uint8 scores, plus the mention ids in row order.
+Files: {prefix}.json (meta), {prefix}.ids, {prefix}.qids (uint32), {prefix}.scores (uint8)
+"""
+
+from __future__ import annotations
+import os, json
+from typing import Tuple
+import numpy as np
+
+candidate_prefix = "candidates/candidates"
+output_tsv_path = "candidates/candidates.tsv"
+
+
+def qid_to_int(qid: str) -> int:
+    return int(qid[1:])
+
+
+def int_to_qid(qid: int) -> str:
+    return f"Q{qid}"
+
+
+class CandidateWriter:
+    """
+    appends rows as they finish; reopening continues an interrupted output
+    """
+
+    def __init__(self, prefix: str, k: int):
+        self.prefix, self.k = prefix, k
+        if os.path.exists(prefix + ".json"):
+            with open(prefix + ".json", "r") as f:
+                if json.load(f)["k"] != k:
+                    raise ValueError(f"{prefix} was written with a different k")
+        else:
+            with open(prefix + ".json", "w") as f:
+                json.dump({"k": k}, f)
+        self.mention_ids = self._truncate_torn()
+        self.ids_file = open(prefix + ".ids", "a")
+        self.qids_file = open(prefix + ".qids", "ab")
+        self.scores_file = open(prefix + ".scores", "ab")
+
+    def _truncate_torn(self) -> list[str]:
+        """
+        cut all files to the number of rows completely written to each of them
+        return: mention ids of the complete rows
+        """
+        if not os.path.exists(self.prefix + ".ids"):
+            return []
+        with open(self.prefix + ".ids", "r") as f:
+            mention_ids = f.read().split("\n")[:-1]
+        num_rows = min(
+            len(mention_ids),
+            os.path.getsize(self.prefix + ".qids") // (4 * self.k),
+            os.path.getsize(self.prefix + ".scores") // self.k,
+        )
+        mention_ids = mention_ids[:num_rows]
+        ids_size = sum(len((id + "\n").encode("utf8")) for id in mention_ids)
+        sizes = {"ids": ids_size, "qids": 4 * self.k * num_rows, "scores": self.k * num_rows}
+        for suffix, size in sizes.items():
+            os.truncate(f"{self.prefix}.{suffix}", size)
+        return mention_ids
+
+    def append(self, mention_id: str, ranked: list[Tuple[str, int]]) -> None:
+        ranked = ranked[: self.k]
+        qids = np.zeros(self.k, dtype=np.uint32)
+        scores = np.zeros(self.k, dtype=np.uint8)
+        qids[: len(ranked)] = [qid_to_int(qid) for qid, _ in ranked]
+        scores[: len(ranked)] = [score for _, score in ranked]
+        self.qids_file.write(qids.tobytes())
+        self.scores_file.write(scores.tobytes())
+        self.ids_file.write(mention_id + "\n")
+
+    def flush(self) -> None:
+        # ids last: a row counts as written once its id is
+        self.qids_file.flush()
+        self.scores_file.flush()
+        self.ids_file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        for f in [self.qids_file, self.scores_file, self.ids_file]:
+            f.close()
+
+    def __enter__(self) -> CandidateWriter:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class CandidateStore:
+    """
+    read-only, memory-mapped; O(1) lookup by mention id
+    """
+
+    def __init__(self, prefix: str):
+        with open(prefix + ".json", "r") as f:
+            self.k: int = json.load(f)["k"]
+        with open(prefix + ".ids", "r") as f:
+            self.mention_ids = f.read().split("\n")[:-1]
+        self.id2row = {id: i for i, id in enumerate(self.mention_ids)}
+        shape = (len(self.mention_ids), self.k)
+        if not self.mention_ids:  # an empty file cannot be memory-mapped
+            self.qids = np.zeros(shape, dtype=np.uint32)
+            self.scores = np.zeros(shape, dtype=np.uint8)
+            return
+        self.qids = np.memmap(prefix + ".qids", dtype=np.uint32, mode="r", shape=shape)
+        self.scores = np.memmap(prefix + ".scores", dtype=np.uint8, mode="r", shape=shape)
+
+    def __len__(self) -> int:
+        return len(self.mention_ids)
+
+    def lookup(self, mention_id: str) -> list[Tuple[str, int]]:
+        """
+        return: ranked (qid, score) of a mention
+        """
+        row = self.id2row[mention_id]
+        return [
+            (int_to_qid(qid), score)
+            for qid, score in zip(self.qids[row].tolist(), self.scores[row].tolist())
+            if qid
+        ]
+
+    def unique_qids(self) -> np.ndarray:
+        """
+        return: sorted unique integer qids over all mentions
+        """
+        qids = np.unique(self.qids)
+        return qids[qids != 0]
+
+    def export_tsv(self, path: str) -> None:
+        """
+        write the same format as the text output of candidates.py
+        """
+        with open(path, "w") as f:
+            for id in self.mention_ids:
+                f.write("\t".join([id] + [qid for qid, _ in self.lookup(id)]) + "\n")
+
+
+def main():
+    CandidateStore(candidate_prefix).export_tsv(output_tsv_path)
+
+
+if __name__ == "__main__":
+    main()
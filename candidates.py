@@ -5,35 +5,146 @@
 Generate top-k candidates from mentions
 """
 from __future__ import annotations
-import os, json
-from typing import Tuple, Dict
+import os, sys, json, time
+import numpy as np
+from typing import Container, Tuple, Dict, Iterator, Sequence
 from fuzzywuzzy import fuzz
 from multiprocessing import Pool
 from tqdm import tqdm
+from ngram_index import NgramIndex
+from scorer import score_top_k
+from name_store import NameStore
+from entity_index import EntityIndex
+from candidate_cache import CandidateCache
+from candidate_store import CandidateWriter, CandidateStore
+import metrics, shards
 
 num_candidates = 100
 num_process = 24
+mention_batch_size = 64  # mentions per task handed to a free worker
 # stdout_interval = 3
 search_wiki = False
+# shortlist entities by the n-gram index before exact scoring instead of scoring all of them
+use_index = True
+shortlist_size = 2000  # entities scored exactly per mention: larger is slower with higher recall
+# "rapidfuzz": score blocks of mentions in native code with partial top-k selection;
+# "fuzzywuzzy": one python call per (mention, entity) and a full sort
+scoring_backend = "rapidfuzz"
+# score every name of an entity (enwiki title, then english label and aliases from
+# qid_fields_path) and rank the entity by its best one; otherwise only the title
+use_aliases = True
+# match case-insensitively, so that mentions differing only in case share one cached result;
+# capitalization is informative for partial_ratio, so this costs some accuracy
+ignore_case = False
 qid_entity_path = "entities/qid-entity.tsv"  # qid <-> entity mapping
+# prefix of the memory-mapped stores of qid_entity_path and of the qid -> entity index,
+# shared by the worker processes and the spider
+entity_store_path = "entities/qid-entity"
+qid_fields_path = "entities/qid-fields.tsv"  # side output of the extractor
 dataset_mention_dir = "mentions"
+# "tsv": output_candidate_path; "binary": output_candidate_prefix, see candidate_store.py
+# either is resumed if present; remove to start over
+output_format = "tsv"
 output_candidate_path = "candidates/candidates.tsv"
+output_candidate_prefix = "candidates/candidates"
+# normalized mention -> ranked candidates, reused across runs while entities and settings are unchanged
+use_cache = True
+candidate_cache_path = "candidates/cache.sqlite"
 output_all_candidate_qids_filepath = "candidates/all-qids.txt"
+# (index, number of shards) with --shard i/N: only the mentions of the shard are matched and
+# every output path above gets a shard suffix, see shards.py
+shard: shards.Shard | None = None
 
 
-def load_entities() -> Tuple[list[str], list[str]]:
+def with_aliases() -> bool:
+    return use_aliases and os.path.exists(qid_fields_path)
+
+
+def load_entities() -> Tuple[list[str], list[str], list[int]]:
     """
-    load qid <-> entity mapping
-    return: list of qids, list of entity names
+    load qid <-> entity mapping, with all names of each entity if use_aliases
+    return: list of qids, list of entity names grouped by entity, each group starting with the
+    enwiki title, start of the group of each qid
     """
-    # TODO load alias
-    qids, entities = [], []
+    qids, entities, groups = [], [], []
+    if with_aliases():
+        for qid, title, label, aliases, _ in load_entity_fields():
+            qids.append(qid)
+            groups.append(len(entities))
+            names = [title]
+            for name in [label] + aliases:
+                if name and name not in names:
+                    names.append(name)
+            entities.extend(names)
+        return qids, entities, groups
     with open(qid_entity_path, "r") as f:
-        for line in f.readlines():
+        for line in f:
             items = line.strip().split("\t")
             qids.append(items[0])
             entities.append(items[1])
-    return qids, entities
+    return qids, entities, list(range(len(qids)))
+
+
+def load_entity_store() -> Tuple[NameStore, NameStore, np.ndarray]:
+    """
+    memory-map the qid <-> entity mapping, building the stores first if outdated
+    return: qids, entity names, start of the names of each qid
+    """
+    qids_path, names_path = entity_store_path + ".qids", entity_store_path + ".names"
+    groups_path, index_path = entity_store_path + ".groups.npy", entity_store_path + ".index"
+    meta_path = entity_store_path + ".json"
+    aliases = with_aliases()
+    # the index is built last, so it is fresh only if the stores are
+    source_path = qid_fields_path if aliases else qid_entity_path
+    fresh = EntityIndex.is_fresh(index_path, source_path) and os.path.exists(meta_path)
+    if fresh:
+        with open(meta_path, "r") as f:
+            fresh = json.load(f)["aliases"] == aliases
+    if not fresh:
+        qids, entities, groups = load_entities()
+        NameStore.build(qids, qids_path)
+        NameStore.build(entities, names_path)
+        np.save(groups_path, np.array(groups, dtype=np.int64))
+        with open(meta_path, "w") as f:
+            json.dump({"aliases": aliases}, f)
+        EntityIndex.build(qids, groups, index_path)
+    return NameStore(qids_path), NameStore(names_path), np.load(groups_path, mmap_mode="r")
+
+
+def load_entity_index() -> EntityIndex:
+    """
+    memory-map the qid -> entity name (enwiki title) index, building the stores first if outdated
+    """
+    _, entities, _ = load_entity_store()
+    return EntityIndex(entity_store_path + ".index", entities)
+
+
+def load_ngram_index(entities: NameStore) -> NgramIndex:
+    """
+    memory-map the n-gram index over the entity names, rebuilt whenever the names are
+    """
+    return NgramIndex.load(entities, entity_store_path + ".names.offsets.npy")
+
+
+def load_entity_fields(
+    qids: Container[str] | None = None,
+) -> Iterator[Tuple[str, str, str, list[str], list[str]]]:
+    """
+    load the multi-field side output written by the extractor, only the lines of qids if given
+    yield: qid, enwiki title, english label, english aliases, P18 image file names
+    """
+    with open(qid_fields_path, "r") as f:
+        for line in f:
+            if qids is not None and line[: line.find("\t")] not in qids:
+                continue
+            qid, title, label, aliases, images = line.rstrip("\n").split("\t")
+            yield (
+                qid,
+                title,
+                label,
+                aliases.split("|") if aliases else [],
+                images.split("|") if images else [],
+            )
 
 
 def load_mentions() -> list[Tuple[str, str, str]]:
@@ -52,75 +163,251 @@ def load_mentions() -> list[Tuple[str, str, str]]:
     return res
 
 
-def match(mention: str, entities: list[str]) -> list[Tuple[int, int]]:
+def normalize_mention(mention: str) -> str:
+    """
+    mentions differing only in spacing (and case, if ignored) share one result
+    """
+    mention = " ".join(mention.split())
+    return mention.lower() if ignore_case else mention
+
+
+def scorer_name() -> str:
+    return "partial_ratio_ignore_case" if ignore_case else "partial_ratio"
+
+
+def match(
+    mention: str, entities: Sequence[str], groups: np.ndarray | None = None
+) -> list[Tuple[int, int]]:
     """
-    for a mention, calculate the similarity score to each entity
+    for a (normalized) mention, calculate the similarity score to each entity
+    groups: start of the names of each entity, scored as its best name; see score_top_k
     return : list of (index, score)
     """
-    scores = [fuzz.partial_ratio(mention, entity) for entity in entities]
+    if scoring_backend == "rapidfuzz":
+        return next(score_top_k([mention], entities, num_candidates, scorer_name(), groups))
+    if ignore_case:
+        scores = [fuzz.partial_ratio(mention, entity.lower()) for entity in entities]
+    else:
+        scores = [fuzz.partial_ratio(mention, entity) for entity in entities]
+    if groups is not None and scores:
+        scores = np.maximum.reduceat(scores, groups).tolist()
     order = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
     return [(index, scores[index]) for index in order[:num_candidates]]
 
 
+def match_indexed(
+    mention: str, entities: Sequence[str], groups: np.ndarray, index: NgramIndex
+) -> Tuple[list[Tuple[int, int]], list[int]]:
+    """
+    exact scoring restricted to the names shortlisted by the index
+    return : list of (entity index, score), and the shortlisted entities
+    """
+    rows = np.sort(index.shortlist(mention, shortlist_size))
+    owners = np.searchsorted(groups, rows, side="right") - 1
+    # the shortlisted names of an entity are consecutive once sorted
+    starts = np.flatnonzero(np.diff(owners, prepend=-1))
+    shortlist = owners[starts].tolist()
+    top_entities = match(mention, [entities[i] for i in rows.tolist()], starts)
+    return [(shortlist[i], score) for i, score in top_entities], shortlist
+
+
+worker_stores: Tuple[NameStore, NameStore, np.ndarray, NgramIndex | None] | None = None
+
+
+def init_worker() -> None:
+    """
+    attach each worker to the shared stores once, instead of once per batch
+    """
+    global worker_stores
+    qids, entities, groups = load_entity_store()
+    worker_stores = qids, entities, groups, load_ngram_index(entities) if use_index else None
+
+
 def match_batch(
-    inputs: Tuple[list[Tuple[str, str, str]], list[str], list[str], int]
-) -> Tuple[list[list[str]], list[str], int]:
-    mentions, entities, qids, process_id = inputs
-    top_qids: list[list[str]] = []
-    qids_all: list[str] = []
-    num_hits = 0
-    pbar = tqdm(enumerate(mentions), total=len(mentions), position=process_id - 1)
-    for i, (id, mention, answer_qid) in pbar:
-        top_entities = match(mention, entities)
-        top_qid = []
-        for i in top_entities:
-            qid = qids[i[0]]
-            top_qid.append(qid)
-            qids_all.append(qid)
-        top_qids.append([id] + top_qid)
-        if answer_qid in top_qid:
-            num_hits += 1
-    return top_qids, qids_all, num_hits
+    mentions: list[Tuple[str, set[str]]]
+) -> list[Tuple[str, list[Tuple[str, int]], set[str]]]:
+    """
+    input: list of (normalized mention, answer qids of the mentions sharing it)
+    return: list of (normalized mention, top (qid, score), answer qids found in the shortlist)
+    """
+    if worker_stores is None:
+        init_worker()
+    qids, entities, groups, index = worker_stores
+    start = time.perf_counter()
+    res = []
+    if index is None and scoring_backend == "rapidfuzz":
+        batched = score_top_k(
+            [m[0] for m in mentions], entities, num_candidates, scorer_name(), groups
+        )
+    for mention, answer_qids in mentions:
+        shortlist_hits: set[str] = set()
+        if index is not None:
+            top_entities, shortlist = match_indexed(mention, entities, groups, index)
+            shortlist_hits = answer_qids & {qids[j] for j in shortlist}
+        elif scoring_backend == "rapidfuzz":
+            top_entities = next(batched)
+        else:
+            top_entities = match(mention, entities, groups)
+        res.append((mention, [(qids[i], score) for i, score in top_entities], shortlist_hits))
+    seconds_per_mention = (time.perf_counter() - start) / len(mentions)
+    for _ in mentions:
+        metrics.observe("candidates_seconds_per_mention", seconds_per_mention)
+    metrics.inc("candidates_mentions_scored_total", len(mentions))
+    metrics.flush()
+    return res
+
+
+def load_completed(path: str) -> list[list[str]]:
+    """
+    read the lines already written by an interrupted run, dropping a torn last line
+    return: list of [id, qid...]
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "r+") as f:
+        content = f.read()
+        complete = content[: content.rfind("\n") + 1]
+        if len(complete) != len(content):
+            f.seek(0)
+            f.truncate(len(complete.encode("utf8")))
+    return [line.split("\t") for line in complete.splitlines()]
+
+
+def cache_signature() -> str:
+    stat = os.stat(qid_fields_path if with_aliases() else qid_entity_path)
+    return json.dumps(
+        [
+            stat.st_size,
+            stat.st_mtime,
+            with_aliases(),
+            scoring_backend,
+            use_index,
+            shortlist_size,
+            ignore_case,
+        ]
+    )
 
 
 def generate() -> list[str]:
     """
     generate candidate qids matching each mention and store them in file.
+    each distinct normalized mention is scored once, or served from the cache;
+    the rest are scored in small batches by whichever worker is free, and written
+    to the file as they finish; mentions already in the file are skipped.
     return all candidate qids for the convenient of the spider
     """
-    qids, entities = load_entities()
-    mentions = load_mentions()
+    # build the stores and the index once before the workers attach to them
+    qids, entities, _ = load_entity_store()
+    if use_index:
+        load_ngram_index(entities)
+    # by normalized mention, so that a shard scores each distinct mention once for all shards
+    mentions = [m for m in load_mentions() if shards.in_shard(normalize_mention(m[1]), shard)]
     num_samples = len(mentions)
-    num_pre_process = (num_samples + num_process - 1) // num_process
-    mentions = [
-        mentions[i * num_pre_process : (i + 1) * num_pre_process]
-        for i in range(num_process)
-    ]
-    process_args = list(
-        zip(
-            mentions,
-            [entities] * num_process,
-            [qids] * num_process,
-            range(1, num_process + 1),
-        )
-    )
-    with Pool(num_process) as pool:
-        outputs = pool.map(match_batch, process_args)
-    num_hits = 0
-    qids_all: list[str] = []
-    with open(output_candidate_path, "w") as f:
-        for output in outputs:
-            for top_qids in output[0]:
-                f.write("\t".join(top_qids) + "\n")
-            num_hits += output[2]
-            qids_all += output[1]
-    print("accuracy:", num_hits / num_samples)
-    return list(set(qids_all))
+    id2answer = {id: answer_qid for id, _, answer_qid in mentions}
+    num_hits = num_shortlist_hits = num_scored = 0
+    qids_all: set[str] = set()
+    if output_format == "binary":
+        prefix = shards.shard_path(output_candidate_prefix, shard)
+        writer = CandidateWriter(prefix, num_candidates)
+        store = CandidateStore(prefix)
+        completed = [[id] + [qid for qid, _ in store.lookup(id)] for id in store.mention_ids]
+    else:
+        completed = load_completed(shards.shard_path(output_candidate_path, shard))
+        writer = open(shards.shard_path(output_candidate_path, shard), "a")
+    for id, *top_qid in completed:
+        qids_all.update(top_qid)
+        if id2answer.get(id) in top_qid:
+            num_hits += 1
+    completed_ids = {line[0] for line in completed}
+    key2mentions: dict[str, list[Tuple[str, str]]] = {}
+    for id, mention, answer_qid in mentions:
+        if id not in completed_ids:
+            key2mentions.setdefault(normalize_mention(mention), []).append((id, answer_qid))
+    cache_path = shards.shard_path(candidate_cache_path, shard)
+    cache = CandidateCache(cache_path, cache_signature()) if use_cache else None
+    pbar = tqdm(total=num_samples, initial=len(completed_ids))
+
+    with writer:
+
+        def _write(key: str, ranked: list[Tuple[str, int]]) -> None:
+            nonlocal num_hits
+            top_qid = [qid for qid, _ in ranked]
+            qids_all.update(top_qid)
+            for id, answer_qid in key2mentions[key]:
+                if output_format == "binary":
+                    writer.append(id, ranked)
+                else:
+                    writer.write("\t".join([id] + top_qid) + "\n")
+                if answer_qid in top_qid:
+                    num_hits += 1
+            pbar.update(len(key2mentions[key]))
+            metrics.inc("candidates_mentions_written_total", len(key2mentions[key]))
+
+        missing = []
+        for key, answers in key2mentions.items():
+            ranked = cache.get(key, num_candidates) if cache else None
+            if ranked is None:
+                missing.append((key, {answer_qid for _, answer_qid in answers}))
+            else:
+                _write(key, ranked)
+        if cache:
+            metrics.inc("candidates_cache_hits_total", len(key2mentions) - len(missing))
+            metrics.inc("candidates_cache_misses_total", len(missing))
+        writer.flush()
+        batches = [
+            missing[i : i + mention_batch_size]
+            for i in range(0, len(missing), mention_batch_size)
+        ]
+        with Pool(num_process, initializer=init_worker) as pool:
+            for output in pool.imap_unordered(match_batch, batches):
+                for key, ranked, shortlist_hits in output:
+                    _write(key, ranked)
+                    if cache:
+                        cache.put(key, num_candidates, ranked)
+                    num_scored += len(key2mentions[key])
+                    num_shortlist_hits += sum(
+                        answer_qid in shortlist_hits for _, answer_qid in key2mentions[key]
+                    )
+                writer.flush()
+                if cache:
+                    cache.commit()
+                pbar.set_description(f"accuracy: {num_hits / pbar.n:.4f}")
+    if cache:
+        cache.close()
+    if use_index and num_scored:
+        print("shortlist recall:", num_shortlist_hits / num_scored)
+    if num_samples:
+        print("accuracy:", num_hits / num_samples)
+    return list(qids_all)
+
+
+def write_manifest(num_qids: int) -> None:
+    qids_path = shards.shard_path(output_all_candidate_qids_filepath, shard)
+    outputs = {"qids": (qids_path, output_all_candidate_qids_filepath)}
+    if output_format == "binary":
+        prefix = shards.shard_path(output_candidate_prefix, shard)
+        outputs["candidate_store"] = prefix, output_candidate_prefix
+        files = [prefix + ext for ext in [".json", ".ids", ".qids", ".scores"]]
+        num_mentions = len(CandidateStore(prefix))
+    else:
+        path = shards.shard_path(output_candidate_path, shard)
+        outputs["candidates"] = path, output_candidate_path
+        files = [path]
+        num_mentions = len(load_completed(path))
+    counts = {"mentions": num_mentions, "qids": num_qids}
+    shards.write_manifest("candidates", shard, outputs, files + [qids_path], counts, [])
 
 
 def main() -> None:
-    with open(output_all_candidate_qids_filepath, "w") as f:
-        f.write("\n".join(generate()))
+    global shard
+    shard = shards.parse_shard_arg(sys.argv)
+    metrics.start()
+    qids_all = generate()
+    with open(shards.shard_path(output_all_candidate_qids_filepath, shard), "w") as f:
+        f.write("\n".join(qids_all))
+    if shard is not None:
+        write_manifest(len(qids_all))
+    metrics.stop()
 
 
 if __name__ == "__main__":
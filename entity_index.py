@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Qid -> entity name lookup by binary search over sorted integer qids, each with its row in a
+NameStore of the names; all memory-mapped read-only, so opening it costs nothing and its pages
+are shared by every process using it
+Files: {path}.keys.npy (sorted uint32 qids), {path}.rows.npy (uint32 row of each in the names)
+"""
+
+from __future__ import annotations
+import os
+import numpy as np
+from typing import Iterable, Sequence
+from name_store import NameStore
+from candidate_store import qid_to_int
+
+
+class EntityIndex:
+    def __init__(self, path: str, names: NameStore):
+        self.keys: np.ndarray = np.load(path + ".keys.npy", mmap_mode="r")
+        self.rows: np.ndarray = np.load(path + ".rows.npy", mmap_mode="r")
+        self.names = names
+
+    @staticmethod
+    def build(qids: Iterable[str], name_rows: Sequence[int], path: str) -> None:
+        """
+        name_rows: row of the name of each qid in the names
+        """
+        keys = np.fromiter(map(qid_to_int, qids), dtype=np.uint32)
+        order = np.argsort(keys, kind="stable")
+        np.save(path + ".keys.npy", keys[order])
+        np.save(path + ".rows.npy", np.asarray(name_rows, dtype=np.uint32)[order])
+
+    @staticmethod
+    def is_fresh(path: str, source_path: str) -> bool:
+        try:
+            return os.path.getmtime(path + ".rows.npy") >= os.path.getmtime(source_path)
+        except FileNotFoundError:
+            return False
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def find(self, qid: str) -> int:
+        """
+        return: position of the qid in keys, -1 if absent or not a qid (Q and up to 32 bits)
+        """
+        digits = qid[1:]
+        if not (qid[:1] == "Q" and digits.isascii() and digits.isdigit()):
+            return -1
+        key = int(digits)
+        if key >= 2**32:
+            return -1
+        i = int(np.searchsorted(self.keys, key))
+        return i if i < len(self.keys) and self.keys[i] == key else -1
+
+    def __contains__(self, qid: str) -> bool:
+        return self.find(qid) >= 0
+
+    def __getitem__(self, qid: str) -> str:
+        i = self.find(qid)
+        if i < 0:
+            raise KeyError(qid)
+        return self.names[int(self.rows[i])]
+
+    def get(self, qid: str, default: str | None = None) -> str | None:
+        i = self.find(qid)
+        return default if i < 0 else self.names[int(self.rows[i])]
@@ -5,28 +5,491 @@
 Extract qid <-> entity name mapping from the huge json file
 """
 
-import ijson
+from __future__ import annotations
+import sys, os, re, time, shutil, gzip, bz2
+import orjson
+from collections import deque
+from multiprocessing import Pool
 from tqdm import tqdm
+import metrics
 
+# .json, or the compressed .json.gz / .json.bz2 as published
 input_entity_filepath = "latest-all.json"
 output_filepath = "qid-entity.tsv"
+# side output written in the same pass, one entity per line with columns:
+# qid, enwiki title, english label, english aliases, P18 image file names (lists joined by '|')
+output_fields_filepath = "qid-fields.tsv"
+list_separator = "|"
+# the dump stores one entity per line, so it can be split into byte ranges parsed in parallel
+# set to 1 to go through the file in a single stream instead
+num_process = 32
+shard_output_dir = "qid-entity-shards"
+# journal of (input offset, output offsets, failure) per shard; run with -r to resume from it
+checkpoint_path = "extractor-checkpoint.jsonl"
+checkpoint_interval = 256 * 2**20  # bytes of input
+# compressed dumps cannot be split at arbitrary bytes:
+# gzip is decompressed in one stream and the lines are parsed in blocks by the pool;
+# a multi-stream bzip2 file as written by pbzip2/lbzip2 (a stream per block) is split at the
+# stream headers, found in one pass, into ranges of whole streams decompressed in parallel;
+# a single-stream bzip2 file is read like gzip. A checkpoint is written after each block / range
+gz_block_size = 64 * 2**20  # bytes of decompressed lines
+bz2_range_size = 64 * 2**20  # bytes of compressed input, at least, in a range of streams
+bz2_read_size = 2**20
+bz2_stream_magic = re.compile(rb"BZh[1-9]1AY&SY")
+
+
+def clean_field(value: str) -> str:
+    return value.replace("\t", " ").replace("\n", " ").replace(list_separator, " ")
+
+
+def entity_images(info: dict) -> list[str]:
+    images = []
+    for claim in info.get("claims", {}).get("P18", []):
+        snak = claim["mainsnak"]
+        if claim.get("rank") != "deprecated" and snak["snaktype"] == "value":
+            images.append(clean_field(snak["datavalue"]["value"]))
+    return images
+
+
+def entity_rows(info: dict) -> tuple[str, str] | None:
+    """
+    return: the output lines of an entity (qid-entity, qid-fields),
+    or None if it has no enwiki title
+    """
+    qid = info["id"]
+    try:
+        title = info["sitelinks"]["enwiki"]["title"]
+    except KeyError:
+        return None
+    label = info.get("labels", {}).get("en", {}).get("value", "")
+    aliases = [clean_field(a["value"]) for a in info.get("aliases", {}).get("en", [])]
+    fields = [
+        qid,
+        clean_field(title),
+        clean_field(label),
+        list_separator.join(aliases),
+        list_separator.join(entity_images(info)),
+    ]
+    return f"{qid}\t{title}\n", "\t".join(fields) + "\n"
+
+
+def parse_line(line: bytes) -> dict | None:
+    """
+    parse one line of the dump: '{...},' or the surrounding '[' / ']'
+    """
+    line = line.strip().rstrip(b",")
+    if line in (b"", b"[", b"]"):
+        return None
+    return orjson.loads(line)
+
+
+def split_ranges(path: str, num_shards: int) -> list[tuple[int, int]]:
+    """
+    split the file into byte ranges, each starting right after a line break
+    return: list of (start, end); a shard owns every line starting in [start, end)
+    """
+    file_size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as f:
+        for i in range(1, num_shards):
+            f.seek(max(file_size * i // num_shards, boundaries[-1]))
+            f.readline()
+            boundaries.append(f.tell())
+    boundaries.append(file_size)
+    return [(s, e) for s, e in zip(boundaries[:-1], boundaries[1:]) if s < e]
+
+
+def shard_path(shard_id: int, output_path: str) -> str:
+    return os.path.join(shard_output_dir, f"{shard_id}-{os.path.basename(output_path)}")
+
+
+def write_checkpoint(record: dict) -> None:
+    # appended by every worker; a single short line with O_APPEND will not interleave
+    with open(checkpoint_path, "ab") as f:
+        f.write(orjson.dumps(record) + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_checkpoints() -> tuple[list[tuple[int, int]], dict[int, dict]]:
+    """
+    return: byte ranges of the checkpointed run, and the latest checkpoint of each shard
+    """
+    ranges, checkpoints = [], {}
+    with open(checkpoint_path, "rb") as f:
+        for line in f:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:  # torn last line
+                break
+            if "ranges" in record:
+                ranges = [tuple(r) for r in record["ranges"]]
+            else:
+                checkpoints[record["shard"]] = record
+    return ranges, checkpoints
+
+
+def open_output(path: str, offset: int | None):
+    """
+    open an output file for appending, truncated to the checkpointed offset;
+    start from an empty file if there is no checkpoint
+    """
+    if offset is None:
+        return open(path, "w")
+    with open(path, "r+b") as f:
+        f.truncate(offset)
+    return open(path, "a")
+
+
+def extract_shard(inputs: tuple[int, int, int, str, str, dict | None]) -> int:
+    """
+    parse all lines in the byte range of a shard and write them to the outputs,
+    checkpointing every `checkpoint_interval` bytes of input
+    return: number of failures
+    """
+    shard_id, start, end, output_path, fields_output_path, checkpoint = inputs
+    if checkpoint is None:
+        pos, failure = start, 0
+        output_offset = fields_output_offset = None
+    else:
+        pos, failure = checkpoint["input"], checkpoint["failure"]
+        output_offset, fields_output_offset = checkpoint["output"], checkpoint["fields_output"]
+        if checkpoint["done"]:
+            return failure
+    with open_output(output_path, output_offset) as outputs, open_output(
+        fields_output_path, fields_output_offset
+    ) as fields_outputs:
+
+        # counted locally and added to the metrics at each checkpoint, off the per-line path
+        counted_pos, num_lines, num_entities, counted_failure = pos, 0, 0, failure
+
+        def _checkpoint(done: bool) -> None:
+            nonlocal counted_pos, num_lines, num_entities, counted_failure
+            metrics.inc("extractor_input_bytes_total", pos - counted_pos)
+            metrics.inc("extractor_lines_total", num_lines)
+            metrics.inc("extractor_entities_total", num_entities)
+            metrics.inc("extractor_failures_total", failure - counted_failure)
+            counted_pos, num_lines, num_entities, counted_failure = pos, 0, 0, failure
+            outputs.flush()
+            fields_outputs.flush()
+            os.fsync(outputs.fileno())
+            os.fsync(fields_outputs.fileno())
+            write_checkpoint(
+                {
+                    "shard": shard_id,
+                    "input": pos,
+                    "output": outputs.tell(),
+                    "fields_output": fields_outputs.tell(),
+                    "failure": failure,
+                    "done": done,
+                }
+            )
+
+        with open(input_entity_filepath, "rb") as inputs_file:
+            inputs_file.seek(pos)
+            last_checkpoint = pos
+            pbar = tqdm(
+                total=end - start,
+                initial=pos - start,
+                unit="B",
+                unit_scale=True,
+                position=shard_id,
+            )
+            while pos < end:
+                line = inputs_file.readline()
+                if not line:
+                    break
+                pos += len(line)
+                pbar.update(len(line))
+                num_lines += 1
+                info = parse_line(line)
+                if info is not None:
+                    rows = entity_rows(info)
+                    if rows is None:
+                        failure += 1
+                    else:
+                        outputs.write(rows[0])
+                        fields_outputs.write(rows[1])
+                        num_entities += 1
+                if pos - last_checkpoint >= checkpoint_interval:
+                    _checkpoint(False)
+                    last_checkpoint = pos
+        _checkpoint(True)
+    metrics.flush()
+    return failure
+
+
+def merge_shards(num_shards: int) -> None:
+    for output_path in [output_filepath, output_fields_filepath]:
+        with open(output_path, "wb") as outputs:
+            for shard_id in range(num_shards):
+                with open(shard_path(shard_id, output_path), "rb") as f:
+                    shutil.copyfileobj(f, outputs)
+    shutil.rmtree(shard_output_dir)
+
+
+def dump_compression(path: str) -> str:
+    for compression in ["gz", "bz2"]:
+        if path.endswith("." + compression):
+            return compression
+    return ""
+
+
+def extract_lines(lines: list[bytes]) -> tuple[list[str], list[str], int]:
+    """
+    return: output lines (qid-entity, qid-fields) and number of failures
+    """
+    rows, fields_rows, failure = [], [], 0
+    for line in lines:
+        info = parse_line(line)
+        if info is None:
+            continue
+        entity = entity_rows(info)
+        if entity is None:
+            failure += 1
+        else:
+            rows.append(entity[0])
+            fields_rows.append(entity[1])
+    metrics.inc("extractor_lines_total", len(lines))
+    metrics.inc("extractor_entities_total", len(rows))
+    metrics.inc("extractor_failures_total", failure)
+    return rows, fields_rows, failure
+
+
+def extract_block(inputs: tuple[int, bytes]):
+    """
+    parse a block of complete lines from the decompressed stream
+    return: same as extract_bz2_range
+    """
+    end, block = inputs
+    with metrics.timer("extractor_block_seconds"):
+        res = (end, b"", *extract_lines(block.splitlines()), b"")
+    metrics.flush()
+    return res
+
+
+def bz2_stream_offsets(path: str) -> list[int]:
+    """
+    return: offsets of all bz2 stream headers in the file
+    """
+    offsets = []
+    with open(path, "rb") as f:
+        buf_start, buf = 0, b""
+        while True:
+            chunk = f.read(bz2_read_size)
+            if not chunk:
+                return offsets
+            buf += chunk
+            offsets.extend(buf_start + m.start() for m in bz2_stream_magic.finditer(buf))
+            # the header may cross the chunk boundary; 9 bytes cannot hold one already found
+            keep = max(len(buf) - 9, 0)
+            buf_start, buf = buf_start + keep, buf[keep:]
+
+
+def bz2_ranges(path: str) -> list[tuple[int, int]]:
+    """
+    split the file at stream headers into ranges of at least bz2_range_size bytes
+    return: list of (start, end), a single range if there is a single stream
+    """
+    file_size = os.path.getsize(path)
+    boundaries = [0]
+    for offset in bz2_stream_offsets(path):
+        if offset - boundaries[-1] >= bz2_range_size:
+            boundaries.append(offset)
+    boundaries.append(file_size)
+    return [(s, e) for s, e in zip(boundaries[:-1], boundaries[1:]) if s < e]
+
+
+def extract_bz2_range(inputs: tuple[int, int]):
+    """
+    decompress the bz2 streams in [start, end), which starts at a stream header and ends at
+    the next range or the end of file, and parse the complete lines in them
+    return: end, bytes before the first line break (completing the line from the previous range),
+    output lines, number of failures, bytes after the last line break (None if there is no line break)
+    """
+    start, end = inputs
+    rows, fields_rows, failure = [], [], 0
+    head, tail = None, b""
+
+    def _consume(data: bytes) -> None:
+        nonlocal head, tail, failure
+        text = tail + data
+        if head is None:
+            i = text.find(b"\n")
+            if i < 0:
+                tail = text
+                return
+            head, text = text[:i], text[i + 1 :]
+        i = text.rfind(b"\n")
+        if i < 0:
+            tail = text
+            return
+        res = extract_lines(text[:i].split(b"\n"))
+        rows.extend(res[0])
+        fields_rows.extend(res[1])
+        failure += res[2]
+        tail = text[i + 1 :]
+
+    range_start = time.perf_counter()
+    with open(input_entity_filepath, "rb") as f:
+        remaining = end - start
+        f.seek(start)
+        decompressor = bz2.BZ2Decompressor()
+        while remaining > 0:
+            data = f.read(min(bz2_read_size, remaining))
+            remaining -= len(data)
+            while data:
+                if decompressor.eof:  # concatenated streams
+                    decompressor = bz2.BZ2Decompressor()
+                _consume(decompressor.decompress(data))
+                data = decompressor.unused_data if decompressor.eof else b""
+    metrics.observe("extractor_block_seconds", time.perf_counter() - range_start)
+    metrics.flush()
+    if head is None:
+        return end, tail, rows, fields_rows, failure, None
+    return end, head, rows, fields_rows, failure, tail
+
+
+def iter_blocks(compression: str, pos: int):
+    with (gzip if compression == "gz" else bz2).open(input_entity_filepath, "rb") as f:
+        f.seek(pos)  # decompresses up to pos when resuming
+        while True:
+            block = b"".join(f.readlines(gz_block_size))
+            if not block:
+                break
+            pos += len(block)
+            yield pos, block
+
+
+def ordered_imap(pool, func, iterable, window: int):
+    """
+    like pool.imap, but never holds more than `window` pending inputs in memory
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def extract_compressed(
+    compression: str, ranges: list[tuple[int, int]], checkpoint: dict | None
+) -> int:
+    """
+    extract from a compressed dump into the outputs, stitching the lines that cross
+    range boundaries in the main process
+    return: number of failures
+    """
+    if checkpoint is None:
+        pos, failure, pending = 0, 0, b""
+        output_offset = fields_output_offset = None
+    else:
+        pos, failure = checkpoint["input"], checkpoint["failure"]
+        pending = checkpoint["pending"].encode("latin-1")
+        output_offset, fields_output_offset = checkpoint["output"], checkpoint["fields_output"]
+        if checkpoint["done"]:
+            return failure
+    with open_output(output_filepath, output_offset) as outputs, open_output(
+        output_fields_filepath, fields_output_offset
+    ) as fields_outputs, Pool(num_process) as pool:
+
+        def _checkpoint(done: bool) -> None:
+            outputs.flush()
+            fields_outputs.flush()
+            os.fsync(outputs.fileno())
+            os.fsync(fields_outputs.fileno())
+            write_checkpoint(
+                {
+                    "shard": 0,
+                    "input": pos,
+                    "output": outputs.tell(),
+                    "fields_output": fields_outputs.tell(),
+                    "failure": failure,
+                    "pending": pending.decode("latin-1"),
+                    "done": done,
+                }
+            )
+
+        def _write(rows: list[str], fields_rows: list[str], fail: int) -> None:
+            nonlocal failure
+            outputs.writelines(rows)
+            fields_outputs.writelines(fields_rows)
+            failure += fail
+
+        if compression == "bz2" and len(ranges) > 1:
+            inputs = [r for r in ranges if r[0] >= pos]
+            results = ordered_imap(pool, extract_bz2_range, inputs, 2 * num_process)
+            pbar = tqdm(total=ranges[-1][1], initial=pos, unit="B", unit_scale=True)
+        else:
+            blocks = iter_blocks(compression, pos)
+            results = ordered_imap(pool, extract_block, blocks, 2 * num_process)
+            pbar = tqdm(initial=pos, unit="B", unit_scale=True)
+        for end, head, rows, fields_rows, fail, tail in results:
+            if tail is None:
+                pending += head
+            else:
+                _write(*extract_lines([pending + head]))
+                pending = tail
+            _write(rows, fields_rows, fail)
+            pbar.update(end - pos)
+            metrics.inc("extractor_input_bytes_total", end - pos)
+            pos = end
+            _checkpoint(False)
+        _write(*extract_lines([pending]))
+        pending = b""
+        _checkpoint(True)
+    return failure
 
 
 def main():
-    print("Reading JSON file...")
-    with open(output_filepath, "w") as outputs:
-        with open(input_entity_filepath, "rb") as inputs:
-            pbar = tqdm(ijson.items(inputs, "item"))
-            failure = 0
-            for info in pbar:
-                qid = info["id"]
-                try:
-                    entity_name = info["sitelinks"]["enwiki"]["title"]
-                except KeyError:
-                    failure += 1
-                    pbar.set_description(f"failure: {failure}")
-                    continue
-                outputs.write(f"{qid}\t{entity_name}\n")
+    resume = len(sys.argv) > 1 and sys.argv[1] == "-r"
+    metrics.start()
+    compression = dump_compression(input_entity_filepath)
+    if resume and os.path.exists(checkpoint_path):
+        ranges, checkpoints = load_checkpoints()
+        print(f"Resuming from checkpoint of {len(checkpoints)} shards...")
+    else:
+        file_size = os.path.getsize(input_entity_filepath)
+        if compression == "bz2":
+            ranges = bz2_ranges(input_entity_filepath)
+        elif num_process > 1 and not compression:
+            ranges = split_ranges(input_entity_filepath, num_process)
+        else:
+            ranges = [(0, file_size)]
+        checkpoints = {}
+        with open(checkpoint_path, "wb") as f:
+            f.write(orjson.dumps({"ranges": ranges}) + b"\n")
+    if compression:
+        print(f"Reading {compression} compressed JSON file...")
+        failure = extract_compressed(compression, ranges, checkpoints.get(0))
+    elif len(ranges) == 1:
+        print("Reading JSON file...")
+        failure = extract_shard(
+            (0, *ranges[0], output_filepath, output_fields_filepath, checkpoints.get(0))
+        )
+    else:
+        print(f"Reading JSON file in {len(ranges)} shards...")
+        os.makedirs(shard_output_dir, exist_ok=True)
+        process_args = [
+            (
+                i,
+                start,
+                end,
+                shard_path(i, output_filepath),
+                shard_path(i, output_fields_filepath),
+                checkpoints.get(i),
+            )
+            for i, (start, end) in enumerate(ranges)
+        ]
+        with Pool(num_process) as pool:
+            failure = sum(pool.map(extract_shard, process_args))
+        print("Merging shards...")
+        merge_shards(len(ranges))
+    os.remove(checkpoint_path)
+    metrics.stop()
+    print(f"failure: {failure}")
 
 
 if __name__ == "__main__":
@@ -2,62 +2,121 @@
 Generate top-k candidates in all wiki entities from mentions
 """
 from __future__ import annotations
-import os, json
+import os, sys, json
 from fuzzywuzzy import process
 from multiprocessing import Pool
 from tqdm import tqdm
+from scorer import score_top_k
+from name_store import NameStore
+from candidates import load_completed
+import shards
 
 num_candidates = 100
 num_process = 32
+mention_batch_size = 64  # mentions per task handed to a free worker
 entity2qid_path = "candidates/ne2qid.json"
+# prefix of the memory-mapped stores of entity2qid, shared by the worker processes
+entity2qid_store_path = "candidates/ne2qid"
 mention_path = "mentions/WIKIMEL_%s.json"
-output_path = "candidates/top100/candidates-answer.tsv"
+output_path = "candidates/top100/candidates-answer.tsv"  # resumed if present; remove to start over
+# "rapidfuzz": batched native scoring, same scorer as process.extract (WRatio); or "fuzzywuzzy"
+scoring_backend = "rapidfuzz"
+# (index, number of shards) with --shard i/N: only the mentions of the shard, written to
+# output_path with a shard suffix, see shards.py
+shard: shards.Shard | None = None
 
 
-def run(inputs) -> dict[str, list[str]]:
-    (
-        entity2qid,
-        candidates,
-        mentions,
-        pid
-    ) = inputs
+def load_entity2qid_store() -> tuple[NameStore, NameStore]:
+    """
+    memory-map the entity -> qid mapping, building the stores first if outdated
+    return: entity names, qids
+    """
+    names_path, qids_path = entity2qid_store_path + ".names", entity2qid_store_path + ".qids"
+    if not NameStore.is_fresh(names_path, entity2qid_path):
+        with open(entity2qid_path, "r") as f:
+            entity2qid: dict[str, str] = json.load(f)
+        NameStore.build(entity2qid.keys(), names_path)
+        NameStore.build(entity2qid.values(), qids_path)
+    return NameStore(names_path), NameStore(qids_path)
+
+
+class IndexedChoices:
+    """
+    index -> name view of a store for process.extract, which takes anything with items() like a
+    dict: the names are decoded as they are scored, instead of copied out of the shared store
+    """
+
+    def __init__(self, names: NameStore):
+        self.names = names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def items(self):
+        return enumerate(self.names)
+
+
+worker_stores: tuple[NameStore, NameStore] | None = None
+
+
+def init_worker() -> None:
+    global worker_stores
+    worker_stores = load_entity2qid_store()
+
+
+def run(mentions: list[tuple[str, str]]) -> dict[str, list[str]]:
+    if worker_stores is None:
+        init_worker()
+    candidates, qids = worker_stores
     res = {}
-    for id, mention in tqdm(mentions, position=pid):
-        extracted = process.extract(mention, candidates, limit=num_candidates)
-        res[id] = [entity2qid[e[0]] for e in extracted]
+    if scoring_backend == "rapidfuzz":
+        extracted = score_top_k(
+            [mention for _, mention in mentions], candidates, num_candidates, "wratio"
+        )
+        for (id, _), top in zip(mentions, extracted):
+            res[id] = [qids[i] for i, _ in top]
+        return res
+    # process.extract on a dict-like yields (choice, score, key)
+    choices = IndexedChoices(candidates)
+    for id, mention in mentions:
+        extracted = process.extract(mention, choices, limit=num_candidates)
+        res[id] = [qids[e[2]] for e in extracted]
     return res
 
 
 def main():
-    with open(entity2qid_path, "r") as f:
-        entity2qid = json.load(f)
-    candidates = list(entity2qid.keys())
+    global shard
+    shard = shards.parse_shard_arg(sys.argv)
+    shard_output_path = shards.shard_path(output_path, shard)
+    load_entity2qid_store()  # build once before the workers attach to it
     id2mention = {}
     for type in ["train", "valid", "test"]:
         with open(mention_path % type, "r") as f:
             mentions = json.load(f)
             for id, info in mentions.items():
-                id2mention[id] = info["mentions"]
+                if shards.in_shard(id, shard):
+                    id2mention[id] = info["mentions"]
+    num_samples = len(id2mention)
+    # resume: skip the mentions already written by an interrupted run
+    for line in load_completed(shard_output_path):
+        id2mention.pop(line[0], None)
     mentions = list(id2mention.items())
-    num_samples = len(mentions)
-    num_pre_process = (num_samples + num_process - 1) // num_process
-    mentions = [
-        mentions[i * num_pre_process : (i + 1) * num_pre_process]
-        for i in range(num_process)
+    batches = [
+        mentions[i : i + mention_batch_size]
+        for i in range(0, len(mentions), mention_batch_size)
     ]
-    res = Pool(num_process).map(
-        run,
-        ((entity2qid, candidates, mention, i) for i, mention in enumerate(mentions)),
-    )
-    # res = [run((entity2qid, candidates, mention, i)) for i, mention in enumerate(mentions)]
-    id2candidate = {}
-    for r in res:
-        id2candidate.update(r)
-    with open(output_path, "w") as f:
-        for id, candidates in id2candidate.items():
-            f.write("\t".join([id] + candidates) + "\n")
+    pbar = tqdm(total=num_samples, initial=num_samples - len(mentions))
+    with Pool(num_process, initializer=init_worker) as pool, open(shard_output_path, "a") as f:
+        for res in pool.imap_unordered(run, batches):
+            for id, candidates in res.items():
+                f.write("\t".join([id] + candidates) + "\n")
+            f.flush()
+            pbar.update(len(res))
+    if shard is not None:
+        outputs = {"candidates": (shard_output_path, output_path)}
+        counts = {"mentions": len(load_completed(shard_output_path))}
+        shards.write_manifest("gen", shard, outputs, [shard_output_path], counts, [])
 
 
 if __name__ == "__main__":
     main()
-
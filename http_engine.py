@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous HTTP fetching: pooled keep-alive connections, per-host concurrency limits,
+and adaptive request rate with exponential backoff honoring Retry-After / maxlag
+"""
+
+from __future__ import annotations
+import os, asyncio, random
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+from urllib.parse import urlsplit
+import aiohttp
+import metrics
+
+retryable_status = {429, 500, 502, 503, 504}
+download_chunk_size = 2**16
+
+
+class FetchError(Exception):
+    pass
+
+
+class Throttled(Exception):
+    """
+    raised while reading a response that asks us to slow down in its body
+    """
+
+    def __init__(self, retry_after: float | None):
+        super().__init__(f"throttled, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Retry-After is either seconds or an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        delay = parsedate_to_datetime(value) - datetime.now(timezone.utc)
+        return max(delay.total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """
+    at most `concurrency` requests in flight to a host, started at least `interval` seconds apart.
+    the interval doubles when the host throttles us and decays back on success (AIMD on the rate)
+    """
+
+    def __init__(self, concurrency: int, max_interval: float = 30.0):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = 0.0
+        self.max_interval = max_interval
+        self.next_start = 0.0
+
+    async def __aenter__(self) -> None:
+        await self.semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def __aexit__(self, *_) -> None:
+        self.semaphore.release()
+
+    def throttled(self, retry_after: float | None) -> None:
+        self.interval = min(max(self.interval * 2, 0.05), self.max_interval)
+        if retry_after:
+            now = asyncio.get_running_loop().time()
+            self.next_start = max(self.next_start, now + retry_after)
+
+    def succeeded(self) -> None:
+        self.interval *= 0.95
+        if self.interval < 0.001:
+            self.interval = 0.0
+
+
+class Fetcher:
+    def __init__(
+        self,
+        headers: dict[str, str],
+        proxy: str | None = None,
+        host_concurrency: dict[str, int] | None = None,
+        default_concurrency: int = 16,
+        retries: int = 6,
+        timeout: float = 30,
+        backoff_base: float = 0.5,
+        max_backoff: float = 60,
+    ):
+        self.headers, self.proxy = headers, proxy
+        self.host_concurrency = host_concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.retries, self.timeout = retries, timeout
+        self.backoff_base, self.max_backoff = backoff_base, max_backoff
+        self.limiters: dict[str, HostLimiter] = {}
+        self.session: aiohttp.ClientSession | None = None
+
+    async def __aenter__(self) -> Fetcher:
+        connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.session.close()
+
+    def limiter(self, url: str) -> HostLimiter:
+        host = urlsplit(url).hostname or ""
+        if host not in self.limiters:
+            concurrency = self.host_concurrency.get(host, self.default_concurrency)
+            self.limiters[host] = HostLimiter(concurrency)
+        return self.limiters[host]
+
+    async def fetch(
+        self, url: str, read: Callable[[aiohttp.ClientResponse], Awaitable[Any]]
+    ) -> Any:
+        """
+        GET the url and return read(response), retrying on connection errors and throttling;
+        read may raise Throttled for throttling signalled in the body (e.g. maxlag)
+        """
+        limiter = self.limiter(url)
+        host = urlsplit(url).hostname or ""
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                async with limiter:
+                    async with self.session.get(url, proxy=self.proxy) as response:
+                        metrics.inc("http_responses_total", host=host, status=response.status)
+                        if response.status in retryable_status:
+                            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                            limiter.throttled(retry_after)
+                        else:
+                            response.raise_for_status()
+                            result = await read(response)
+                            limiter.succeeded()
+                            return result
+            except Throttled as e:
+                retry_after = e.retry_after
+                limiter.throttled(retry_after)
+                metrics.inc("http_throttled_total", host=host)
+            except aiohttp.ClientResponseError as e:
+                if e.status not in retryable_status:
+                    raise FetchError(f"HTTP {e.status}: {url}") from e
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                metrics.inc("http_connection_errors_total", host=host)
+            if attempt < self.retries:
+                metrics.inc("http_retries_total", host=host)
+                backoff = min(self.backoff_base * 2**attempt, self.max_backoff)
+                await asyncio.sleep(max(retry_after or 0, backoff * random.uniform(0.5, 1)))
+        raise FetchError(f"All retries failed: {url}")
+
+    async def get_json(self, url: str) -> Any:
+        async def _read(response: aiohttp.ClientResponse) -> Any:
+            content = await response.json(content_type=None)
+            if isinstance(content, dict) and content.get("error", {}).get("code") == "maxlag":
+                raise Throttled(parse_retry_after(response.headers.get("Retry-After")) or 5)
+            return content
+
+        return await self.fetch(url, _read)
+
+    async def get_bytes(self, url: str) -> bytes:
+        async def _read(response: aiohttp.ClientResponse) -> bytes:
+            return await response.read()
+
+        return await self.fetch(url, _read)
+
+    async def download(self, url: str, path: str, max_size: int = 0) -> bool:
+        """
+        stream the response body to path, giving up as soon as it exceeds max_size bytes
+        (0 for unlimited), whether or not the size was announced in content-length
+        returns: whether the file was written
+        """
+
+        async def _read(response: aiohttp.ClientResponse) -> bool:
+            if max_size and (response.content_length or 0) > max_size:
+                return False
+            size, complete = 0, True
+            try:
+                with open(path + ".part", "wb") as f:
+                    async for chunk in response.content.iter_chunked(download_chunk_size):
+                        size += len(chunk)
+                        if max_size and size > max_size:
+                            complete = False
+                            break
+                        f.write(chunk)
+            except BaseException:
+                metrics.inc("http_downloaded_bytes_total", size, host=response.url.host)
+                os.remove(path + ".part")
+                raise
+            metrics.inc("http_downloaded_bytes_total", size, host=response.url.host)
+            if complete:
+                os.replace(path + ".part", path)
+            else:
+                os.remove(path + ".part")
+            return complete
+
+        return await self.fetch(url, _read)
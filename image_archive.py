@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Rolling tar shards of downloaded images, content-addressed so that an image shared by many
+entities (flags, coats of arms, maps) is stored once, with an index from the Commons file title
+to the stored member so that it is downloaded once as well.
+Files: {dir}/images-00000.tar, ... and {dir}/index.sqlite
+"""
+
+from __future__ import annotations
+import os, hashlib, sqlite3, tarfile
+
+shard_size = 2**30  # bytes per tar shard before rolling over to the next
+hash_block_size = 2**20
+
+
+def file_sha1(path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(hash_block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ImageArchive:
+    def __init__(self, dir: str, max_shard_size: int = shard_size):
+        self.dir, self.max_shard_size = dir, max_shard_size
+        os.makedirs(dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(dir, "index.sqlite"))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS members (member TEXT PRIMARY KEY, shard TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS titles (title TEXT PRIMARY KEY, member TEXT)")
+        self.db.commit()
+        # a shard left by a previous run may end in a torn member; never append to it
+        self.num_shards = len([f for f in os.listdir(dir) if f.endswith(".tar")])
+        self.tar: tarfile.TarFile | None = None
+        self.shard = ""
+
+    def lookup(self, title: str) -> str | None:
+        """
+        returns: the member holding the file with this title, if already stored
+        """
+        row = self.db.execute("SELECT member FROM titles WHERE title = ?", (title,)).fetchone()
+        return row[0] if row else None
+
+    def shard_of(self, member: str) -> str:
+        row = self.db.execute("SELECT shard FROM members WHERE member = ?", (member,)).fetchone()
+        return row[0]
+
+    def _writable_tar(self) -> tarfile.TarFile:
+        if self.tar is not None and self.tar.fileobj.tell() >= self.max_shard_size:
+            self.tar.close()
+            self.tar = None
+        if self.tar is None:
+            self.shard = f"images-{self.num_shards:05d}.tar"
+            self.tar = tarfile.open(os.path.join(self.dir, self.shard), "w")
+            self.num_shards += 1
+        return self.tar
+
+    def add(self, title: str, path: str) -> str:
+        """
+        move the downloaded file at path into the archive, unless the same content is stored
+        returns: the member holding it, named by content hash
+        """
+        sha1 = file_sha1(path)
+        member = f"{sha1[:2]}/{sha1}{os.path.splitext(path)[1]}"
+        row = self.db.execute("SELECT 1 FROM members WHERE member = ?", (member,)).fetchone()
+        if row is None:
+            tar = self._writable_tar()
+            tar.add(path, arcname=member)
+            tar.fileobj.flush()  # the member is complete on disk before it is indexed
+            self.db.execute("INSERT INTO members VALUES (?, ?)", (member, self.shard))
+        self.db.execute("INSERT OR REPLACE INTO titles VALUES (?, ?)", (title, member))
+        self.db.commit()
+        os.remove(path)
+        return member
+
+    def close(self) -> None:
+        if self.tar is not None:
+            self.tar.close()
+        self.db.close()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Ranking of an entity's candidate images by their API metadata (imageinfo),
+so that only the best few have to be downloaded
+"""
+
+from __future__ import annotations
+import re
+from typing import Callable, Tuple
+from rapidfuzz import fuzz, utils
+
+# wiki maintenance icons and project logos embedded in articles; never a picture of the entity.
+# Matched as whole tokens of the file name (extension included), so that e.g. "Iconostasis ..."
+# or "Portal of ..." are kept; "icon" only names an icon in an svg file
+excluded_name_pattern = re.compile(
+    r"((^|[\s_-])(ambox|circle-information|question[\s_]book|edit-clear|padlock|disambig|"
+    r"portal-puzzle|symbol[\s_](support|oppose|question)|red[\s_]pog|"
+    r"(commons|wiki(pedia|quote|source|species|books|news|versity|voyage|data|media)|wiktionary)"
+    r"-logo)|"
+    r"^(crystal[\s_]clear|nuvola|oojs[\s_]ui|folder[\s_]hexagonal))(?=[\s_.-]|$)|"
+    r"(^|[\s_-])icon(?=[\s_.-])[^.]*\.svg$",
+    re.IGNORECASE,
+)
+min_image_side = 100  # smaller images are thumbnails of icons, bullets, etc.
+target_pixels = 640 * 480  # resolution beyond this earns no more score
+mime_weights = {
+    "image/jpeg": 1.0,
+    "image/png": 0.8,
+    "image/tiff": 0.8,
+    "image/gif": 0.5,
+    "image/svg+xml": 0.3,  # mostly maps, flags, diagrams and logos
+}
+# weights of name similarity to the entity title, resolution and mime type
+similarity_weight, resolution_weight, mime_weight = 0.5, 0.3, 0.2
+
+
+def image_name(label: str) -> str:
+    """
+    'File:Big_Ben 2012.jpg' -> 'Big Ben 2012'
+    """
+    name = label[label.find(":") + 1 :]
+    if "." in name:
+        name = name[: name.rfind(".")]
+    return name.replace("_", " ")
+
+
+def metadata_score(title: str, label: str, image: dict) -> float | None:
+    """
+    image: imageinfo with size and mime
+    returns: score in [0, 1], or None if the image should never be chosen
+    """
+    name = image_name(label)
+    width, height = image.get("width", 0), image.get("height", 0)
+    excluded = excluded_name_pattern.search(label[label.find(":") + 1 :])
+    if excluded or min(width, height) < min_image_side:
+        return None
+    similarity = fuzz.token_set_ratio(title, name, processor=utils.default_process) / 100
+    resolution = min(width * height / target_pixels, 1.0)
+    return (
+        similarity_weight * similarity
+        + resolution_weight * resolution
+        + mime_weight * mime_weights.get(image.get("mime", ""), 0.0)
+    )
+
+
+# name -> function(entity title, image label, imageinfo) -> score or None to exclude
+rankers: dict[str, Callable[[str, str, dict], float | None]] = {"metadata": metadata_score}
+
+
+def rank_images(
+    title: str, images: list[Tuple[str, dict]], ranker: str = "metadata"
+) -> list[Tuple[str, dict]]:
+    """
+    images: (label, imageinfo) of the candidate images of an entity
+    returns: the images not excluded, best first; ties keep the input order
+    """
+    score_func = rankers[ranker]
+    scored = [(score_func(title, label, image), i) for i, (label, image) in enumerate(images)]
+    scored = [(score, i) for score, i in scored if score is not None]
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    return [images[i] for _, i in scored]
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms, aggregated across worker processes and exported periodically.
+Every process writes a snapshot of its own metrics to metrics_dir; the process that called
+start() sums them up into export_path, as Prometheus text or, for a .jsonl path, one JSON line
+per export. Also an opt-in sampling profiler toggled by a signal, writing collapsed stacks
+(flamegraph / speedscope format) for the process that received it: `kill -USR1 <pid>` to start,
+again to stop and write profile-<pid>.txt
+"""
+
+from __future__ import annotations
+import os, sys, time, json, glob, signal, threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator
+
+metrics_dir = "metrics"  # per-process snapshots
+export_path = "metrics.prom"  # aggregated over processes; or e.g. "metrics.jsonl"
+export_interval = 30  # seconds
+latency_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]  # seconds
+enable_profiler = False  # install the signal handler in start(), inherited by forked workers
+profiler_signal = signal.SIGUSR1 if hasattr(signal, "SIGUSR1") else None
+profiler_interval = 0.005  # seconds between samples
+
+# (name, sorted label items) -> value / [count per bucket..., count above all buckets, sum]
+counters: dict[tuple, float] = {}
+histograms: dict[tuple, list[float]] = {}
+lock = threading.Lock()
+last_flush = time.monotonic()
+
+
+def _after_fork() -> None:
+    """
+    metrics inherited through fork belong to the parent, as may the lock held by its exporter
+    """
+    global lock, last_flush, profiler
+    lock = threading.Lock()
+    counters.clear()
+    histograms.clear()
+    last_flush, profiler = time.monotonic(), None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+    maybe_flush()
+
+
+def observe(name: str, value: float, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        if key not in histograms:
+            histograms[key] = [0.0] * (len(latency_buckets) + 2)
+        hist = histograms[key]
+        i = 0
+        while i < len(latency_buckets) and value > latency_buckets[i]:
+            i += 1
+        hist[i] += 1
+        hist[-1] += value
+    maybe_flush()
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def snapshot() -> dict:
+    with lock:
+        return {
+            "counters": [[name, dict(labels), v] for (name, labels), v in counters.items()],
+            "histograms": [[name, dict(labels), h] for (name, labels), h in histograms.items()],
+        }
+
+
+def flush() -> None:
+    """
+    write the snapshot of this process; call at the end of a task in a pool worker,
+    as a worker may be terminated before its next periodic flush
+    """
+    global last_flush
+    last_flush = time.monotonic()
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def maybe_flush() -> None:
+    if time.monotonic() - last_flush >= export_interval / 2:
+        flush()
+
+
+def aggregate() -> dict:
+    """
+    returns: snapshot summed over all processes
+    """
+    total_counters: dict[tuple, float] = {}
+    total_histograms: dict[tuple, list[float]] = {}
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        try:
+            with open(path, "r") as f:
+                snap = json.load(f)
+        except (OSError, ValueError):  # removed by a new run
+            continue
+        for name, labels, v in snap["counters"]:
+            key = (name, tuple(sorted(labels.items())))
+            total_counters[key] = total_counters.get(key, 0) + v
+        for name, labels, h in snap["histograms"]:
+            key = (name, tuple(sorted(labels.items())))
+            total = total_histograms.setdefault(key, [0.0] * len(h))
+            for i, v in enumerate(h):
+                total[i] += v
+    return {
+        "counters": [[name, dict(labels), v] for (name, labels), v in total_counters.items()],
+        "histograms": [[name, dict(labels), h] for (name, labels), h in total_histograms.items()],
+    }
+
+
+def format_labels(labels: dict, **extra) -> str:
+    items = {**labels, **extra}
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items.items()) + "}"
+
+
+def prometheus_text(snap: dict) -> str:
+    lines, typed = [], set()
+    for name, labels, v in sorted(snap["counters"], key=lambda x: x[0]):
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{format_labels(labels)} {v:g}")
+    for name, labels, h in sorted(snap["histograms"], key=lambda x: x[0]):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0.0
+        for le, count in zip(latency_buckets + ["+Inf"], h[:-1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels, le=le)} {cumulative:g}")
+        lines.append(f"{name}_sum{format_labels(labels)} {h[-1]:g}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative:g}")
+    return "\n".join(lines) + "\n"
+
+
+def export() -> None:
+    flush()
+    snap = aggregate()
+    if export_path.endswith(".jsonl"):
+        with open(export_path, "a") as f:
+            f.write(json.dumps({"time": time.time(), **snap}) + "\n")
+    else:
+        with open(export_path + ".tmp", "w") as f:
+            f.write(prometheus_text(snap))
+        os.replace(export_path + ".tmp", export_path)
+
+
+stop_event = threading.Event()
+
+
+def start() -> None:
+    """
+    call in the main process before creating workers: clears the snapshots of previous runs
+    and exports every export_interval seconds in the background until stop()
+    """
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        os.remove(path)
+    if enable_profiler and profiler_signal is not None:
+        signal.signal(profiler_signal, toggle_profiler)
+    stop_event.clear()
+
+    def _export_loop() -> None:
+        while not stop_event.wait(export_interval):
+            export()
+
+    threading.Thread(target=_export_loop, daemon=True).start()
+
+
+def stop() -> None:
+    stop_event.set()
+    export()
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    samples the stack of a thread, counting each distinct stack
+    """
+
+    def __init__(self, thread_id: int):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks: Counter = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(profiler_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+profiler: SamplingProfiler | None = None
+
+
+def toggle_profiler(*_) -> None:
+    global profiler
+    if profiler is None:
+        profiler = SamplingProfiler(threading.main_thread().ident)
+        profiler.start()
+    else:
+        profiler.stopped.set()
+        profiler.join()
+        profiler.write(f"profile-{os.getpid()}.txt")
+        profiler = None
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Compact string array: one utf8 blob of newline-terminated strings plus an offset array,
+memory-mapped read-only so that any number of worker processes share the same pages
+"""
+
+from __future__ import annotations
+import os, mmap
+from array import array
+from typing import Iterable, Iterator
+import numpy as np
+
+
+class NameStore:
+    def __init__(self, path: str):
+        with open(path + ".blob", "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # mmap of an empty file is not allowed
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.offsets: np.ndarray = np.load(path + ".offsets.npy", mmap_mode="r")
+
+    @staticmethod
+    def build(strings: Iterable[str], path: str) -> None:
+        """
+        strings must not contain line breaks
+        """
+        offsets = array("q", [0])
+        with open(path + ".blob", "wb") as f:
+            for s in strings:
+                offsets.append(offsets[-1] + f.write((s + "\n").encode("utf8")))
+        np.save(path + ".offsets.npy", np.frombuffer(offsets, dtype=np.int64))
+
+    @staticmethod
+    def is_fresh(path: str, source_path: str) -> bool:
+        """
+        whether the store exists and was built after the source file was last modified
+        """
+        try:
+            return os.path.getmtime(path + ".offsets.npy") >= os.path.getmtime(source_path)
+        except FileNotFoundError:
+            return False
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            if start >= stop:
+                return []
+            text = self.blob[self.offsets[start] : self.offsets[stop]].decode("utf8")
+            return text.split("\n")[:-1]
+        if i < 0:
+            i += len(self)
+        return self.blob[self.offsets[i] : self.offsets[i + 1] - 1].decode("utf8")
+
+    def __iter__(self) -> Iterator[str]:
+        chunk_size = 2**16
+        for start in range(0, len(self), chunk_size):
+            yield from self[start : start + chunk_size]
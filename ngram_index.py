@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Character n-gram inverted index over entity names,
+used to shortlist plausible entities for a mention before exact fuzzy scoring
+"""
+
+from __future__ import annotations
+import os, zlib
+from array import array
+from typing import Sequence
+import numpy as np
+from tqdm import tqdm
+
+index_dir = "entities/ngram-index"
+ngram_size = 3
+num_buckets = 2**22  # n-grams are hashed into this many posting lists
+# n-grams shared by more names than this carry little information ("the", "of ");
+# they are only looked up if a mention has nothing else
+max_posting_size = 500000
+
+
+def name_ngrams(name: str) -> list[int]:
+    """
+    return: sorted unique bucket ids of the n-grams of a name, padded to mark word boundaries
+    """
+    name = f" {name.lower()} "
+    if len(name) <= ngram_size:
+        grams = {name}
+    else:
+        grams = {name[i : i + ngram_size] for i in range(len(name) - ngram_size + 1)}
+    return sorted({zlib.crc32(gram.encode("utf8")) % num_buckets for gram in grams})
+
+
+class NgramIndex:
+    """
+    posting lists in CSR layout: names containing bucket b are postings[offsets[b]:offsets[b+1]]
+    """
+
+    def __init__(self, offsets: np.ndarray, postings: np.ndarray, gram_counts: np.ndarray):
+        self.offsets = offsets
+        self.postings = postings
+        self.gram_counts = gram_counts
+
+    @staticmethod
+    def build(names: Sequence[str]) -> NgramIndex:
+        buckets, owners = array("I"), array("I")
+        gram_counts = np.zeros(len(names), dtype=np.int32)
+        for i, name in enumerate(tqdm(names, desc="building n-gram index")):
+            grams = name_ngrams(name)
+            buckets.extend(grams)
+            owners.extend([i] * len(grams))
+            gram_counts[i] = len(grams)
+        bucket_ids = np.frombuffer(buckets, dtype=np.uint32)
+        postings = np.frombuffer(owners, dtype=np.uint32)[np.argsort(bucket_ids, kind="stable")]
+        offsets = np.zeros(num_buckets + 1, dtype=np.int64)
+        np.cumsum(np.bincount(bucket_ids, minlength=num_buckets), out=offsets[1:])
+        return NgramIndex(offsets, postings, gram_counts)
+
+    def save(self) -> None:
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ["offsets", "postings", "gram_counts"]:
+            np.save(os.path.join(index_dir, name + ".npy"), getattr(self, name))
+
+    @staticmethod
+    def is_fresh(source_path: str) -> bool:
+        """
+        whether the index exists and was built after the source file of the names was last modified
+        """
+        try:
+            path = os.path.join(index_dir, "gram_counts.npy")
+            return os.path.getmtime(path) >= os.path.getmtime(source_path)
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def load(names: Sequence[str], source_path: str) -> NgramIndex:
+        """
+        memory-map the persisted index (shared by all processes through the page cache),
+        building it first if missing or older than source_path, the file the names come from
+        """
+        paths = [
+            os.path.join(index_dir, name + ".npy") for name in ["offsets", "postings", "gram_counts"]
+        ]
+        fresh = NgramIndex.is_fresh(source_path)
+        if fresh:
+            fresh = len(np.load(paths[-1], mmap_mode="r")) == len(names)
+        if not fresh:
+            NgramIndex.build(names).save()
+        return NgramIndex(*[np.load(path, mmap_mode="r") for path in paths])
+
+    def shortlist(self, mention: str, size: int) -> np.ndarray:
+        """
+        rank names by the fraction of the n-grams of the shorter string (mention or name)
+        found in the other, which approximates fuzz.partial_ratio
+        return: indices of the top `size` names, unordered
+        """
+        grams = name_ngrams(mention)
+        lengths = self.offsets[np.array(grams) + 1] - self.offsets[grams]
+        selected = [g for g, l in zip(grams, lengths) if l <= max_posting_size]
+        if not selected:
+            selected = [grams[int(np.argmin(lengths))]]
+        postings = np.concatenate(
+            [self.postings[self.offsets[g] : self.offsets[g + 1]] for g in selected]
+        )
+        if len(postings) == 0:
+            return postings
+        hits = np.bincount(postings, minlength=len(self.gram_counts))
+        candidates = np.flatnonzero(hits)
+        scores = hits[candidates] / np.minimum(self.gram_counts[candidates], len(grams))
+        if len(candidates) > size:
+            candidates = candidates[np.argpartition(-scores, size)[:size]]
+        return candidates
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe record of the spider's progress: per qid its status, brief, stored images
+and the archive shards holding them, committed as each batch of qids finishes.
+The JSON outputs of the spider are materialized from it.
+"""
+
+from __future__ import annotations
+import json, sqlite3
+from typing import Iterable, Iterator, Tuple
+
+journal_path = "spider-progress.sqlite"
+output_qid_brief_path = "qid2brief.json"
+failed_qid_file_path = "failed.txt"
+
+# skipped: qids without an entity; unresolved: titles without an article (missing or
+# disambiguation page), which like done ones are never retried
+done, failed, skipped, unresolved = "done", "failed", "skipped", "unresolved"
+
+
+class ProgressJournal:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS progress "
+            "(qid TEXT PRIMARY KEY, status TEXT, brief TEXT, images TEXT, archive TEXT)"
+        )
+        self.db.commit()
+
+    def completed(self) -> set[str]:
+        """
+        returns: qids that need no more work; failed ones are retried
+        """
+        rows = self.db.execute("SELECT qid FROM progress WHERE status != ?", (failed,))
+        return {qid for qid, in rows}
+
+    def record(self, results: Iterable[Tuple[str, str, str, list[str], str]]) -> None:
+        """
+        results: (qid, status, brief, image archive members, archive shards separated by |),
+        written in one transaction
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?, ?)",
+                [
+                    (qid, status, brief, json.dumps(images), archive)
+                    for qid, status, brief, images, archive in results
+                ],
+            )
+
+    def rows(self) -> Iterator[Tuple[str, str, str, list[str], str]]:
+        """
+        yield: records as given to record(), by qid
+        """
+        rows = self.db.execute("SELECT * FROM progress ORDER BY qid")
+        for qid, status, brief, images, archive in rows:
+            yield qid, status, brief, json.loads(images), archive
+
+    def counts(self) -> dict[str, int]:
+        """
+        returns: number of qids per status
+        """
+        rows = self.db.execute("SELECT status, COUNT(*) FROM progress GROUP BY status")
+        return {status: count for status, count in rows}
+
+    def failed_qids(self) -> list[str]:
+        rows = self.db.execute("SELECT qid FROM progress WHERE status = ?", (failed,))
+        return [qid for qid, in rows]
+
+    def export(self, brief_path: str, failed_path: str) -> None:
+        qid2brief = {
+            qid: brief
+            for qid, brief in self.db.execute(
+                "SELECT qid, brief FROM progress WHERE status = ? AND brief != ''", (done,)
+            )
+        }
+        with open(brief_path, "w") as f:
+            json.dump(qid2brief, f)
+        with open(failed_path, "w") as f:
+            f.write("\n".join(self.failed_qids()))
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def main():
+    journal = ProgressJournal(journal_path)
+    journal.export(output_qid_brief_path, failed_qid_file_path)
+    journal.close()
+
+
+if __name__ == "__main__":
+    main()
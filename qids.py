@@ -2,42 +2,222 @@
 # @Date    : 2022-10-26 08:33:18
 # @Author  : Shangyu.Xing (starreeze@foxmail.com)
 """
-Qid operations: generate qids from candidates, or obtaining the difference between two qid files
+Qid operations: generate qids from candidates, or union / intersection / difference of qid files.
+Qids are handled as integers (Q123 -> 123) in sorted uint32 blocks, merged as streams, so memory
+does not grow with the size of the files. A qid file is text (a qid per line) or, with suffix
+.u32, a binary array of sorted unique uint32.
+python qids.py union|intersection|difference <input>... -o <output>: difference is the first
+input minus the rest; python qids.py count <input>...; python qids.py gen
 """
 
 from __future__ import annotations
+import os, sys, itertools, tempfile
+import numpy as np
 from tqdm import tqdm
-from typing import Iterable
+from typing import Iterable, Iterator
+from candidate_store import CandidateStore, int_to_qid
 
-def read_qids(file_path: str) -> list[str]:
+binary_suffix = ".u32"
+block_size = 2**16  # qids read at a time from each input while merging
+run_size = 2**20  # qids sorted in memory at a time; more are sorted in runs spilled to disk
+
+Blocks = Iterator[np.ndarray]  # ascending uint32 blocks, unique across blocks
+
+
+def sorted_unique(values: np.ndarray) -> np.ndarray:
+    """
+    np.unique, which may hash instead of sort and is much slower on large arrays of qids
+    """
+    values = np.sort(values)
+    if not len(values):
+        return values
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+
+def parse_qids(text: str) -> np.ndarray:
+    return np.array(text.replace("Q", "").split(), dtype=np.uint32)
+
+
+def read_binary(file_path: str) -> Blocks:
+    with open(file_path, "rb") as f:
+        while True:
+            block = np.fromfile(f, dtype=np.uint32, count=block_size)
+            if not len(block):
+                return
+            yield block
+
+
+def read_text(file_path: str) -> Iterator[np.ndarray]:
+    """
+    yield: unsorted blocks of the qids in a text file
+    """
     with open(file_path, "r") as f:
-        qids = [line.strip() for line in f.readlines() if line != "" and line != "\n"]
-    return qids
+        rest = ""
+        while True:
+            text = f.read(block_size * 8)
+            if not text:
+                if rest:
+                    yield parse_qids(rest)
+                return
+            # the last line may continue in the next read, or span several without a line break
+            text = rest + text
+            end = text.rfind("\n") + 1
+            yield parse_qids(text[:end])
+            rest = text[end:]
+
+
+def sort_runs(blocks: Iterable[np.ndarray]) -> Blocks:
+    """
+    sort unsorted blocks, possibly with duplicates: in memory up to run_size qids,
+    beyond that by merging sorted runs written to temporary files
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        runs: list[str] = []
+        pending: list[np.ndarray] = []
+        num_pending = 0
+        for block in blocks:
+            pending.append(block)
+            num_pending += len(block)
+            if num_pending >= run_size:
+                runs.append(os.path.join(tmp_dir, f"{len(runs)}{binary_suffix}"))
+                sorted_unique(np.concatenate(pending)).tofile(runs[-1])
+                pending, num_pending = [], 0
+        last = sorted_unique(np.concatenate(pending)) if pending else np.zeros(0, dtype=np.uint32)
+        last_blocks = (last[i : i + block_size] for i in range(0, len(last), block_size))
+        if not runs:
+            yield from last_blocks
+            return
+        yield from merge([read_binary(run) for run in runs] + [last_blocks], "union")
+
+
+def read_qids(file_path: str) -> Blocks:
+    if file_path.endswith(binary_suffix):
+        return read_binary(file_path)
+    return sort_runs(read_text(file_path))
+
+
+def write_qids(file_path: str, blocks: Iterable[np.ndarray]) -> int:
+    """
+    returns: number of qids written
+    """
+    count = 0
+    binary = file_path.endswith(binary_suffix)
+    with open(file_path, "wb" if binary else "w") as f:
+        for block in blocks:
+            if binary:
+                block.astype(np.uint32).tofile(f)
+            elif len(block):
+                f.write("\n".join(map(int_to_qid, block.tolist())) + "\n")
+            count += len(block)
+    return count
 
-def write_qids(file_path: str, qids: Iterable[str]) -> None:
-    with open(file_path, "w") as f:
-        f.write("\n".join(qids))
+
+def merge(streams: list[Blocks], op: str) -> Blocks:
+    """
+    op: union, intersection or difference (the first stream minus the others)
+    each round takes from every stream the values up to the smallest of the last values
+    buffered, so the values beyond it, yet to come from the stream that bounds it, cannot
+    affect the result of the round
+    """
+    empty = np.zeros(0, dtype=np.uint32)
+    buffers = [empty] * len(streams)
+    exhausted = [False] * len(streams)
+    while True:
+        for i, stream in enumerate(streams):
+            while not exhausted[i] and not len(buffers[i]):
+                block = next(stream, None)
+                if block is None:
+                    exhausted[i] = True
+                else:
+                    buffers[i] = block
+        if op == "intersection" and any(exhausted) or op == "difference" and exhausted[0]:
+            return
+        live = [buffer[-1] for buffer in buffers if len(buffer)]
+        if not live:
+            return
+        bound = min(live)
+        parts = []
+        for i, buffer in enumerate(buffers):
+            split = np.searchsorted(buffer, bound, side="right")
+            parts.append(buffer[:split])
+            buffers[i] = buffer[split:]
+        if op == "union":
+            result = sorted_unique(np.concatenate(parts))
+        elif op == "intersection":
+            # in every part, that is len(parts) times in a row once sorted
+            values, n = np.sort(np.concatenate(parts)), len(parts)
+            result = values[n - 1 :][values[n - 1 :] == values[: len(values) - n + 1]]
+        elif op == "difference":
+            result = parts[0]
+            if len(parts) > 1:
+                result = result[~np.isin(result, np.concatenate(parts[1:]))]
+        else:
+            raise ValueError(f"unknown set operation {op}")
+        for i in range(0, len(result), block_size):  # at most one block from each stream
+            yield result[i : i + block_size]
+
+
+def union(file_paths: list[str]) -> Blocks:
+    return merge([read_qids(path) for path in file_paths], "union")
+
+
+def intersection(file_paths: list[str]) -> Blocks:
+    return merge([read_qids(path) for path in file_paths], "intersection")
+
+
+def difference(file_paths: list[str]) -> Blocks:
+    return merge([read_qids(path) for path in file_paths], "difference")
 
 
 def diff():
     qids_1 = "candidates/top100/all-qids.txt"
     qids_2 = "candidates/top50/all-qids.txt"
     qids_output = "candidates/top100/qids-100diff50.txt"
-    qids_set = set(read_qids(qids_2))
-    qids_result = [qid for qid in read_qids(qids_1) if qid not in qids_set]
-    write_qids(qids_output, qids_result)
+    write_qids(qids_output, difference([qids_1, qids_2]))
+
+
+def candidate_qids(candidate_file: str, candidate_prefix: str) -> Iterator[np.ndarray]:
+    """
+    yield: unsorted blocks of the qids in the candidates, from the binary output if present
+    """
+    if os.path.exists(candidate_prefix + ".json"):
+        store = CandidateStore(candidate_prefix)
+        rows = max(block_size // store.k, 1)
+        for i in tqdm(range(0, len(store), rows)):
+            block = np.asarray(store.qids[i : i + rows]).ravel()
+            yield block[block != 0]
+        return
+    with open(candidate_file, "r") as f:
+        for lines in iter(lambda: list(itertools.islice(f, block_size // 16)), []):
+            yield parse_qids("\t".join(line.split("\t", 1)[1] for line in lines if "\t" in line))
 
 
 def gen():
     candidate_file = 'candidates/top100/candidates.tsv'
+    candidate_prefix = 'candidates/top100/candidates'  # binary output, used if present
     output_file = 'candidates/top100/qids.txt'
-    qids: set[str] = set()
-    with open(candidate_file, "r") as f:
-        for line in tqdm(f.readlines()):
-            for qid in line.strip().split('\t')[1:]:
-                qids.add(qid)
-    write_qids(output_file, qids)
+    write_qids(output_file, sort_runs(candidate_qids(candidate_file, candidate_prefix)))
+
+
+operations = {"union": union, "intersection": intersection, "difference": difference}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] == "gen":
+        gen()
+        return
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == "count":
+        for path in args:
+            print(f"{path}: {sum(len(block) for block in read_qids(path))}")
+        return
+    if command not in operations or "-o" not in args:
+        sys.exit(__doc__)
+    i = args.index("-o")
+    output_path, inputs = args[i + 1], args[:i] + args[i + 2 :]
+    count = write_qids(output_path, operations[command](inputs))
+    print(f"{command} of {len(inputs)} files: {count} qids written to {output_path}")
 
 
 if __name__ == "__main__":
-    gen()
+    main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of API JSON responses keyed by normalized request parameters,
+with expiry after a TTL and least-recently-used eviction beyond a total size
+"""
+
+from __future__ import annotations
+import time, json, zlib, sqlite3
+from typing import Any
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+commit_interval = 256  # puts between commits
+evict_interval = 1024  # puts between size checks
+
+
+def normalize_url(url: str) -> str:
+    """
+    the same request whatever the order of its parameters and of the |-separated titles
+    """
+    parts = urlsplit(url)
+    params = []
+    for k, v in parse_qsl(parts.query, keep_blank_values=True):
+        if k == "titles":
+            v = "|".join(sorted(v.split("|")))
+        params.append((k, v))
+    return f"{parts.netloc}{parts.path}?{urlencode(sorted(params))}"
+
+
+class ResponseCache:
+    def __init__(self, path: str, ttl: float, max_size: int):
+        """
+        ttl: seconds a response stays valid; max_size: bytes of compressed responses to keep
+        """
+        self.ttl, self.max_size = ttl, max_size
+        self.hits = self.misses = 0
+        self.num_puts = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, fetched REAL, accessed REAL, value BLOB)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.evict()
+
+    def get(self, url: str) -> Any | None:
+        """
+        returns: the decoded response, or None if not cached or expired
+        """
+        key = normalize_url(url)
+        row = self.db.execute(
+            "SELECT fetched, value FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or row[0] + self.ttl < now:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, url: str, content: Any) -> None:
+        now = time.time()
+        value = zlib.compress(json.dumps(content, ensure_ascii=False).encode("utf8"))
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+            (normalize_url(url), now, now, value),
+        )
+        self.num_puts += 1
+        if self.num_puts % evict_interval == 0:
+            self.evict()
+        elif self.num_puts % commit_interval == 0:
+            self.db.commit()
+
+    def evict(self) -> None:
+        """
+        drop expired responses, then the least recently used until within max_size
+        """
+        self.db.execute("DELETE FROM responses WHERE fetched < ?", (time.time() - self.ttl,))
+        size = self.db.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM responses").fetchone()[0]
+        if size > self.max_size:
+            excess = size - self.max_size
+            removed, last_accessed = 0, None
+            for accessed, length in self.db.execute(
+                "SELECT accessed, LENGTH(value) FROM responses ORDER BY accessed"
+            ):
+                removed += length
+                last_accessed = accessed
+                if removed >= excess:
+                    break
+            self.db.execute("DELETE FROM responses WHERE accessed <= ?", (last_accessed,))
+        self.db.commit()
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        return f"{self.hits} hits, {self.misses} misses ({self.hits / max(total, 1):.1%} hit rate)"
+
+    def close(self) -> None:
+        self.evict()
+        self.db.close()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Batched fuzzy scoring of mentions against entity names in native code (rapidfuzz),
+with partial top-k selection instead of a full sort
+"""
+
+from __future__ import annotations
+from typing import Iterator, Sequence, Tuple
+import numpy as np
+from rapidfuzz import fuzz, process, utils
+
+# name -> (scorer, processor); wratio with default_process is what fuzzywuzzy.process.extract uses
+scorers = {
+    "partial_ratio": (fuzz.partial_ratio, None),
+    "partial_ratio_ignore_case": (fuzz.partial_ratio, str.lower),
+    "wratio": (fuzz.WRatio, utils.default_process),
+}
+mention_block_size = 64  # rows of a score matrix
+entity_chunk_size = 2**18  # columns of a score matrix, bounding its memory
+num_workers = 1  # threads of rapidfuzz in each process; -1 for all cores
+
+
+def top_k(
+    scores: np.ndarray, k: int, ties: np.ndarray | None = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    row-wise top-k of a score matrix, by descending score and, among equal scores, ascending tie
+    value (by default the column), so that the selection is the same as a stable full sort
+    ties: non-negative values below 2**32, of the shape of scores
+    return: column indices and scores, both of shape [rows, min(k, columns)]
+    """
+    if ties is None:
+        ties = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    # unique within a row, larger is better
+    keys = scores.astype(np.int64) * 2**32 - ties
+    if scores.shape[1] > k:
+        columns = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(keys, columns, axis=1), axis=1)
+    columns = np.take_along_axis(columns, order, axis=1)
+    return columns, np.take_along_axis(scores, columns, axis=1)
+
+
+def score_top_k(
+    mentions: Sequence[str],
+    entities: Sequence[str],
+    k: int,
+    scorer: str = "partial_ratio",
+    groups: np.ndarray | None = None,
+) -> Iterator[list[Tuple[int, int]]]:
+    """
+    score blocks of mentions against chunks of entities, keeping a running top-k per mention;
+    each chunk of entities is materialized once (entities may be a memory-mapped NameStore)
+    groups: ascending start index of each run of consecutive names that belong to one entity,
+    which then scores as its best name, before top-k; chunks hold whole groups
+    yield: for each mention in order, list of (entity index, score) by descending score,
+    the index being that of the group if grouped
+    """
+    scorer_func, processor = scorers[scorer]
+    best_indices = np.zeros((len(mentions), 0), dtype=np.int64)
+    best_scores = np.zeros((len(mentions), 0), dtype=np.uint8)
+    num_groups = len(entities) if groups is None else len(groups)
+    chunk_start = 0
+    while chunk_start < num_groups:
+        if groups is None:
+            chunk_end = min(chunk_start + entity_chunk_size, num_groups)
+            name_start, name_end = chunk_start, chunk_end
+        else:
+            name_start = int(groups[chunk_start])
+            chunk_end = int(np.searchsorted(groups, name_start + entity_chunk_size))
+            chunk_end = max(chunk_end, chunk_start + 1)
+            name_end = int(groups[chunk_end]) if chunk_end < num_groups else len(entities)
+            reduce_at = np.asarray(groups[chunk_start:chunk_end], dtype=np.intp) - name_start
+        chunk = entities[name_start:name_end]
+        block_indices, block_scores = [], []
+        for block_start in range(0, len(mentions), mention_block_size):
+            block = slice(block_start, block_start + mention_block_size)
+            scores = process.cdist(
+                mentions[block],
+                chunk,
+                scorer=scorer_func,
+                processor=processor,
+                dtype=np.uint8,
+                workers=num_workers,
+            )
+            if groups is not None:
+                scores = np.maximum.reduceat(scores, reduce_at, axis=1)
+            indices, scores = top_k(scores, k)
+            indices = np.concatenate([best_indices[block], indices + chunk_start], axis=1)
+            scores = np.concatenate([best_scores[block], scores], axis=1)
+            columns, scores = top_k(scores, k, ties=indices)
+            block_indices.append(np.take_along_axis(indices, columns, axis=1))
+            block_scores.append(scores)
+        if block_indices:
+            best_indices = np.concatenate(block_indices)
+            best_scores = np.concatenate(block_scores)
+        chunk_start = chunk_end
+    for indices, scores in zip(best_indices.tolist(), best_scores.tolist()):
+        yield list(zip(indices, scores))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded runs across machines: with `--shard i/N`, candidates.py and gen.py take the mentions and
+spider.py the qids that hash to shard i of N, write their outputs with suffix .shard-i-of-N and
+a manifest of them ({stage}-manifest.shard-i-of-N.json: counts, checksums, failed ids).
+python shards.py merge <manifest>...: check that the manifests cover all N shards of a stage
+and that their files are intact, then combine the outputs into the unsharded paths (relative to
+the current directory), in shard order and by id within a shard, so that the result does not
+depend on which node finished first.
+Paths in a manifest are relative to its directory, so the directory of each node can be copied
+anywhere to merge.
+"""
+
+from __future__ import annotations
+import os, sys, json, shutil, zlib, sqlite3
+from typing import Tuple
+import qids, candidates
+from candidate_store import CandidateStore, CandidateWriter
+from image_archive import file_sha1
+from progress_journal import ProgressJournal
+
+shard_flag = "--shard"
+manifest_name = "%s-manifest.json"
+
+Shard = Tuple[int, int]  # index, number of shards
+
+
+def parse_shard_arg(argv: list[str]) -> Shard | None:
+    """
+    remove `--shard i/N` from argv
+    returns: (i, N), or None if not given
+    """
+    if shard_flag not in argv:
+        return None
+    i = argv.index(shard_flag)
+    index, num_shards = map(int, argv[i + 1].split("/"))
+    del argv[i : i + 2]
+    if not 0 <= index < num_shards:
+        raise ValueError(f"shard {index} out of range for {num_shards} shards")
+    return index, num_shards
+
+
+def shard_of(key: str, num_shards: int) -> int:
+    """
+    stable across processes and machines, unlike hash()
+    """
+    return zlib.crc32(key.encode("utf8")) % num_shards
+
+
+def in_shard(key: str, shard: Shard | None) -> bool:
+    return shard is None or shard_of(key, shard[1]) == shard[0]
+
+
+def shard_path(path: str, shard: Shard | None) -> str:
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+def write_manifest(
+    stage: str,
+    shard: Shard,
+    outputs: dict[str, Tuple[str, str]],
+    files: list[str],
+    counts: dict[str, int],
+    failed: list[str],
+) -> str:
+    """
+    outputs: role -> (output of this shard, unsharded path it is merged into)
+    files: all files making up the outputs, checksummed
+    returns: path of the manifest
+    """
+    path = shard_path(manifest_name % stage, shard)
+    base = os.path.dirname(os.path.abspath(path))
+    manifest = {
+        "stage": stage,
+        "shard": shard[0],
+        "num_shards": shard[1],
+        "outputs": {
+            role: {"path": os.path.relpath(output, base), "merged": merged}
+            for role, (output, merged) in outputs.items()
+        },
+        "files": {
+            os.path.relpath(file, base): {"size": os.path.getsize(file), "sha1": file_sha1(file)}
+            for file in files
+        },
+        "counts": counts,
+        "failed": failed,
+    }
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def load_manifests(paths: list[str]) -> list[dict]:
+    """
+    returns: manifests in shard order, output paths resolved; raises ValueError unless they are
+    exactly the shards of one stage, with every file as it was written
+    """
+    manifests = []
+    for path in paths:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+        for file, info in manifest["files"].items():
+            file = os.path.join(base, file)
+            if os.path.getsize(file) != info["size"] or file_sha1(file) != info["sha1"]:
+                raise ValueError(f"{file} does not match manifest {path}")
+        for output in manifest["outputs"].values():
+            output["path"] = os.path.join(base, output["path"])
+        manifests.append(manifest)
+    manifests.sort(key=lambda m: m["shard"])
+    stages = {(m["stage"], m["num_shards"]) for m in manifests}
+    if len(stages) != 1:
+        raise ValueError(f"manifests of different runs: {sorted(stages)}")
+    num_shards = manifests[0]["num_shards"]
+    shards = [m["shard"] for m in manifests]
+    if shards != list(range(num_shards)):
+        raise ValueError(f"expected shards 0..{num_shards - 1}, got {shards}")
+    return manifests
+
+
+def role_paths(manifests: list[dict], role: str) -> Tuple[list[str], str]:
+    """
+    returns: output of each shard for the role, merged path
+    """
+    paths = [manifest["outputs"][role]["path"] for manifest in manifests]
+    return paths, manifests[0]["outputs"][role]["merged"]
+
+
+def merge_tsv(paths: list[str], merged: str) -> None:
+    with open(merged, "w") as f:
+        for path in paths:
+            for line in sorted(candidates.load_completed(path), key=lambda line: line[0]):
+                f.write("\t".join(line) + "\n")
+
+
+def merge_candidates(manifests: list[dict]) -> None:
+    if "candidates" in manifests[0]["outputs"]:
+        merge_tsv(*role_paths(manifests, "candidates"))
+    else:
+        prefixes, merged = role_paths(manifests, "candidate_store")
+        stores = [CandidateStore(prefix) for prefix in prefixes]
+        for ext in [".json", ".ids", ".qids", ".scores"]:
+            if os.path.exists(merged + ext):
+                os.remove(merged + ext)
+        with CandidateWriter(merged, stores[0].k) as writer:
+            for store in stores:
+                for id in sorted(store.mention_ids):
+                    writer.append(id, store.lookup(id))
+    qid_paths, merged_qids = role_paths(manifests, "qids")
+    qids.write_qids(merged_qids, qids.union(qid_paths))
+
+
+def merge_gen(manifests: list[dict]) -> None:
+    merge_tsv(*role_paths(manifests, "candidates"))
+
+
+def merge_spider(manifests: list[dict]) -> None:
+    """
+    tar shards are linked into the merged archive prefixed with the shard they come from,
+    and the journals rewritten to refer to them by the new names
+    """
+    archive_dirs, merged_dir = role_paths(manifests, "archive")
+    os.makedirs(merged_dir, exist_ok=True)
+    journal_paths, merged_journal = role_paths(manifests, "journal")
+    for path in [os.path.join(merged_dir, "index.sqlite"), merged_journal]:
+        if os.path.exists(path):
+            os.remove(path)
+    index = sqlite3.connect(os.path.join(merged_dir, "index.sqlite"))
+    index.execute("CREATE TABLE IF NOT EXISTS members (member TEXT PRIMARY KEY, shard TEXT)")
+    index.execute("CREATE TABLE IF NOT EXISTS titles (title TEXT PRIMARY KEY, member TEXT)")
+    journal = ProgressJournal(merged_journal)
+    for manifest, archive_dir, journal_path in zip(manifests, archive_dirs, journal_paths):
+        prefix = f"shard-{manifest['shard']}-"
+        for name in sorted(os.listdir(archive_dir)):
+            source = os.path.join(archive_dir, name)
+            target = os.path.join(merged_dir, prefix + name)
+            if not name.endswith(".tar") or os.path.exists(target):
+                continue
+            try:
+                os.link(source, target)
+            except OSError:  # another file system
+                shutil.copyfile(source, target)
+        shard_index = sqlite3.connect(os.path.join(archive_dir, "index.sqlite"))
+        with index:
+            # the same member in several shards has the same content: keep the first
+            index.executemany(
+                "INSERT OR IGNORE INTO members VALUES (?, ?)",
+                [
+                    (member, prefix + shard)
+                    for member, shard in shard_index.execute(
+                        "SELECT member, shard FROM members ORDER BY member"
+                    )
+                ],
+            )
+            index.executemany(
+                "INSERT OR IGNORE INTO titles VALUES (?, ?)",
+                shard_index.execute("SELECT title, member FROM titles ORDER BY title"),
+            )
+        shard_index.close()
+        shard_journal = ProgressJournal(journal_path)
+        journal.record(
+            (qid, status, brief, images, "|".join(prefix + a for a in archive.split("|") if a))
+            for qid, status, brief, images, archive in shard_journal.rows()
+        )
+        shard_journal.close()
+    index.close()
+    journal.export(role_paths(manifests, "briefs")[1], role_paths(manifests, "failed")[1])
+    journal.close()
+
+
+mergers = {"candidates": merge_candidates, "gen": merge_gen, "spider": merge_spider}
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] != "merge":
+        sys.exit(__doc__)
+    manifests = load_manifests(sys.argv[2:])
+    stage = manifests[0]["stage"]
+    mergers[stage](manifests)
+    total: dict[str, int] = {}
+    for manifest in manifests:
+        for key, count in manifest["counts"].items():
+            total[key] = total.get(key, 0) + count
+    failed = sum(len(manifest["failed"]) for manifest in manifests)
+    print(f"merged {len(manifests)} shards of {stage}: {total}, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,51 +6,75 @@ Spider for getting wikipedia images and briefs from wikidata qid
 """
 
 from __future__ import annotations
-from functools import reduce
-import sys, os, requests, time, json
-from bs4 import BeautifulSoup as bs
-from multiprocessing import Pool
+import sys, os, asyncio, hashlib
 from pathlib import Path
-from math import inf
+from typing import Any, Awaitable, Callable, List, Tuple
 from tqdm import tqdm
-from urllib.parse import quote, unquote
-from .candidates import load_entities
+from urllib.parse import quote, unquote, urlencode, urlsplit, parse_qs
+from candidates import load_entity_index, load_entity_fields
+from http_engine import Fetcher, FetchError
+from image_ranker import rank_images
+from response_cache import ResponseCache
+import progress_journal
+from progress_journal import ProgressJournal
+from image_archive import ImageArchive
+from entity_index import EntityIndex
+import metrics, shards
 
 
 # params that can be freely changed
 enable_download_image = True
-num_thread = 8
-checkpoint_interval = 4096
-image_download_path = "images"
-image_default_width = ""
-# in this list file size limit will be ignored
-image_fallback_width = ["1024px", "800px", "640px", "320px", ""]
-pixel_image_extension_names = ["jpg", "png", "gif", "jpeg", "tif"]
-vector_image_extension_names = ["svg"]
-max_file_size = 4 * 2**20  # 4MB
-allow_unkonwn_file_size = True
+# take image file names from the P18 claims in the extractor's side output when available,
+# saving the image label query for those entities
+use_dump_images = True
+# the spider is a pipeline of stages connected by bounded queues, all asynchronous in one process:
+# entity title -> image labels & brief -> image info & ranking -> download & archive -> journal;
+# workers per stage (the first two work on batches of batch_size qids, downloads on single qids)
+page_query_workers = 4
+image_query_workers = 4
+download_workers = 64
+queue_size = 8  # batches of qids buffered between stages
+# requests in flight per host, over pooled keep-alive connections
+host_concurrency = {"en.wikipedia.org": 32, "www.wikidata.org": 16, "upload.wikimedia.org": 64}
+# retries with exponential backoff, honoring Retry-After / maxlag
+max_retries = 6
+# API responses are cached on disk so that reruns and retries only query what is missing
+use_api_cache = True
+api_cache_path = "api-cache.sqlite"
+api_cache_ttl = 30 * 86400  # seconds
+api_cache_max_size = 2**30  # bytes, compressed
+checkpoint_interval = 4096  # qids per batch selected by -s / -l
+image_download_path = "images"  # staging directory of images being downloaded
+# the original is downloaded if within max_file_size, otherwise a thumbnail of this width
+image_thumb_width = 1024
+image_mime_types = ["image/jpeg", "image/png", "image/gif", "image/tiff", "image/svg+xml"]
+max_file_size = 4 * 2**20  # 4MB, enforced while streaming
+# candidate images are ranked by metadata (see image_ranker.py) and only the best are downloaded,
+# falling back to the next candidate when a download fails
+image_ranker = "metadata"
+images_per_entity = 1
 failed_qid_file_path = "failed.txt"
+# per-qid progress, committed as qids finish; resume skips what it records as finished
+journal_path = "spider-progress.sqlite"
 output_qid_brief_path = "qid2brief.json"
 qid_file_path = "test.txt"
 proxy_url = "http://114.212.87.91:7890"
 zip_image = True
 # zip_store_dir = "/aliyun/wiki_images"
+# images are stored in rolling tar shards here, each distinct file once (see image_archive.py)
 zip_store_dir = "images_zipped"
+image_shard_size = 2**30
+# (index, number of shards) with --shard i/N: only the qids of the shard are processed and
+# the files above get a shard suffix, see shards.py
+shard: shards.Shard | None = None
 
 # better not change these below
-loop_callback = lambda batch_idx: os.system(
-    f"tar cvf {zip_store_dir}/batch_{batch_idx}.tar {image_download_path} && rm {image_download_path}/*"
-)
-batch_size = 1
-proxy = {"http": proxy_url, "https": proxy_url}
+batch_size = 50  # qids per batch, the API accepts at most 50 titles per request
+proxy = proxy_url
 head = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/85.0.4183.83 Safari/537.36"
 }
-wikipedia_url = "https://en.wikipedia.org/wiki/%s"
-# params: qid (Q21)
-# returns: full wididata page, see samples/england_wikidata.html
-
-entity_name_query_image_label_brief_url = "https://en.wikipedia.org/w/api.php?action=query&titles=%s&prop=images|extracts&exintro&explaintext&redirects=1&format=json"
+entity_name_query_image_label_brief_url = "https://en.wikipedia.org/w/api.php?action=query&titles=%s&prop=images|extracts|pageprops&ppprop=disambiguation&exintro&explaintext&exlimit=max&imlimit=max&redirects=1&format=json&maxlag=5"
 # params: list of entity names separated by |
 # returns:
 """
@@ -64,7 +88,8 @@ entity_name_query_image_label_brief_url = "https://en.wikipedia.org/w/api.php?ac
                 "pageid": 9316,
                 "ns": 0,
                 "title": "England",
-                "extracts": "..."
+                "extracts": "...",
+                "pageprops": {"disambiguation": ""}  # only for disambiguation pages
                 "images": [
                     {
                         "ns": 6,
@@ -72,7 +97,24 @@ entity_name_query_image_label_brief_url = "https://en.wikipedia.org/w/api.php?ac
                     }...]}
 """
 
-image_label_query_image_url = "https://en.wikipedia.org/w/api.php?action=query&titles=%s&prop=imageinfo&iiprop=url&format=json"
+qid_query_enwiki_title_url = "https://www.wikidata.org/w/api.php?action=wbgetentities&ids=%s&props=sitelinks&sitefilter=enwiki&format=json&maxlag=5"
+# params: list of qids separated by |
+# returns:
+"""
+{   "entities": {
+        "Q21": {
+            "type": "item",
+            "id": "Q21",
+            "sitelinks": {"enwiki": {"site": "enwiki", "title": "England", "badges": []}}
+        }},
+    "success": 1
+}
+"""
+
+entity_name_query_brief_url = "https://en.wikipedia.org/w/api.php?action=query&titles=%s&prop=extracts&exintro&explaintext&exlimit=max&redirects=1&format=json&maxlag=5"
+# params: list of entity names separated by |; returns: same as above without images
+
+image_label_query_image_url = "https://en.wikipedia.org/w/api.php?action=query&titles=%s&prop=imageinfo&iiprop=url|size|mime&iiurlwidth=%d&format=json&maxlag=5"
 # params: list of file labels separated by |
 # returns:
 """
@@ -86,9 +128,16 @@ image_label_query_image_url = "https://en.wikipedia.org/w/api.php?action=query&t
                 "known": "",
                 "imagerepository": "shared",
                 "imageinfo": [{
+                    "size": 3377489,
+                    "width": 4000,
+                    "height": 2666,
+                    "thumburl": "https://upload.wikimedia.org/wikipedia/commons/thumb/4/49/1_christ_church_hall_2012.jpg/1024px-1_christ_church_hall_2012.jpg",
+                    "thumbwidth": 1024,
+                    "thumbheight": 683,
                     "url": "https://upload.wikimedia.org/wikipedia/commons/4/49/1_christ_church_hall_2012.jpg",
                     "descriptionurl": "https://commons.wikimedia.org/wiki/File:1_christ_church_hall_2012.jpg",
-                    "descriptionshorturl": "https://commons.wikimedia.org/w/index.php?curid=18896931"
+                    "descriptionshorturl": "https://commons.wikimedia.org/w/index.php?curid=18896931",
+                    "mime": "image/jpeg"
                 }]}}}}
 """
 
@@ -101,238 +150,491 @@ def url_unquote(s: str) -> str:
     return unquote(s, encoding="utf8")
 
 
-def assign_resolution(url: str, res: str) -> str:
-    if res == "":
-        return url
-    # find the 5th '/' in url and add '/thumb' before it
-    i, count = 0, 0
-    while True:
-        if url[i] == "/":
-            count += 1
-            if count == 5:
+# created in process_batches, shared by all coroutines
+fetcher: Fetcher | None = None
+api_cache: ResponseCache | None = None
+journal: ProgressJournal | None = None  # opened in main
+image_archive: ImageArchive | None = None
+downloading: dict[str, asyncio.Future] = {}  # image label -> archive member, while in flight
+
+
+def api_endpoint(url: str) -> str:
+    """
+    e.g. 'query:images|extracts|pageprops', to label metrics
+    """
+    params = parse_qs(urlsplit(url).query)
+    return ":".join(params.get("action", []) + params.get("prop", []))
+
+
+async def get(url: str) -> dict:
+    """
+    returns: the decoded JSON response of an API request, read through the cache if enabled
+    raises FetchError for an API error (e.g. ratelimited, readonly), which MediaWiki returns
+    with HTTP 200 instead of the query, so that the qids fail and are retried by the next run
+    rather than taken for missing pages
+    """
+    endpoint = api_endpoint(url)
+    if api_cache is not None:
+        content = api_cache.get(url)
+        if content is not None:
+            metrics.inc("spider_api_cache_hits_total", endpoint=endpoint)
+            return content
+        metrics.inc("spider_api_cache_misses_total", endpoint=endpoint)
+    with metrics.timer("spider_api_seconds", endpoint=endpoint):
+        content = await fetcher.get_json(url)
+    if "error" in content:
+        error = content["error"]
+        raise FetchError(f"API error {error.get('code')}: {error.get('info', '')} ({url})")
+    if api_cache is not None:
+        api_cache.put(url, content)
+    return content
+
+
+async def query_titles(url: str, titles: list[str]) -> dict[str, dict]:
+    """
+    query the API with up to batch_size titles per request, following continuation until complete
+    (e.g. images beyond imlimit, extracts beyond exlimit)
+    returns: input title -> page info merged over continuations, after normalization and redirects
+    (pages may be "missing", e.g. files hosted on commons, which still come with imageinfo)
+    """
+    res: dict[str, dict] = {}
+    for i in range(0, len(titles), batch_size):
+        batch = titles[i : i + batch_size]
+        mapping: dict[str, str] = {}
+        pages: dict[str, dict] = {}
+        continue_params: dict[str, str] = {}
+        while True:
+            query_url = url % url_quote("|".join(batch))
+            if continue_params:
+                query_url += "&" + urlencode(continue_params)
+            content = await get(query_url)
+            query = content.get("query", {})
+            for item in query.get("normalized", []) + query.get("redirects", []):
+                mapping[item["from"]] = item["to"]
+            for page in query.get("pages", {}).values():
+                merged = pages.setdefault(page["title"], {})
+                for k, v in page.items():
+                    if isinstance(v, list):
+                        merged.setdefault(k, []).extend(v)
+                    else:
+                        merged[k] = v
+            if "continue" not in content:
                 break
-        i += 1
-    url = url[:i] + "/thumb" + url[i:]
-    # add suffix
-    url += f"/{res}-" + url[url.rfind("/") + 1 :]
-    extension = url[url.rfind(".") + 1 :]
-    if extension in vector_image_extension_names:
-        url += ".png"
-    return url
-
-
-def get(url: str, retries=3, sleeps=1, timeout=6, **kwargs) -> requests.Response:
-    while retries:
-        try:
-            r = requests.get(
-                url,
-                timeout=timeout,
-                headers=head,
-                allow_redirects=True,
-                proxies=proxy,
-                **kwargs,
-            )
-            break
-        except (
-            requests.exceptions.ReadTimeout,
-            requests.exceptions.ConnectTimeout,
-            requests.exceptions.ConnectionError,
-            requests.exceptions.TooManyRedirects,
-        ):
-            retries -= 1
-            time.sleep(sleeps)
-    if retries == 0:
-        raise requests.exceptions.ConnectionError("All retries failed: {}".format(url))
-    return r
-
-
-def entity_name_query_brief(entity: str) -> str:
-    labels_json = get(
-        "https://en.wikipedia.org/w/api.php?action=query&titles=%s&prop=extracts&exintro&explaintext&redirects=1&format=json"
-        % url_quote(entity)
-    ).json()
-    page_info = list(labels_json["query"]["pages"].values())[0]
-    return url_unquote(page_info["extract"].strip().replace("\n", " "))
-
-
-def entity_name_query_image_label_brief(
-    entity_names: list[str],
-) -> tuple[list[list[str]], list[str]]:
-    """
-    input a batch: I once thought API would return all the result at once;
-    however, it returns only 10 images labels in total. Not feel like changing this back.
-    returns: list of image labels for each qid, size: [batch_size, <=10]; and a list of brief introduction for each entity
-    """
-    image_labels: list[list[str]] = []
-    brief = []
-
-    def append_entity_label_brief(entity: str) -> None:
-        nonlocal image_labels, brief
-        labels_json = get(
-            entity_name_query_image_label_brief_url % url_quote(entity)
-        ).json()
-        page_info = list(labels_json["query"]["pages"].values())[0]
-        for image in page_info["images"]:
-            image_labels[-1].append(url_unquote(image["title"].strip()))
-        brief.append(url_unquote(page_info["extract"].strip().replace("\n", " ")))
-
-    for entity in entity_names:
-        image_labels.append([])
-        try:
-            append_entity_label_brief(entity)
-        except KeyError:
-            # no images: page redirected, see https://en.wikipedia.org/wiki/China_(region)
-            # get full wikipedia page to obtain real entity
-            soup = bs(get(wikipedia_url % url_quote(entity)).content, "lxml")
-            new_entity = soup.title.text  # 'Greater China - Wikipedia'
-            append_entity_label_brief(new_entity[: new_entity.rfind(" -")])
-    return image_labels, brief
-
-
-def image_label_query_image(labels: list[str]) -> list[str]:
-    """
-    input a batch (in just one query)
-    returns: list of image download URLs
-    """
-    images_json = get(image_label_query_image_url % url_quote("|".join(labels))).json()
-    res = []
-    for image in images_json["query"]["pages"].values():
-        url: str = image["imageinfo"][0]["url"].strip()
-        extension_name = url[url.rfind(".") + 1 :]
+            continue_params = content["continue"]
+        for title in batch:
+            target, seen = title, set()
+            while target in mapping and target not in seen:
+                seen.add(target)
+                target = mapping[target]
+            if target in pages:
+                res[title] = pages[target]
+    return res
+
+
+def page_brief(page_info: dict) -> str:
+    return url_unquote(page_info.get("extract", "").strip().replace("\n", " "))
+
+
+async def entity_name_query_brief(entity_names: list[str]) -> list[str]:
+    pages = await query_titles(entity_name_query_brief_url, entity_names)
+    return [page_brief(pages[entity]) if entity in pages else "" for entity in entity_names]
+
+
+def page_resolved(page_info: dict) -> bool:
+    """
+    whether the page is an existing article and not a disambiguation page
+    """
+    return (
+        "missing" not in page_info
+        and "invalid" not in page_info
+        and "disambiguation" not in page_info.get("pageprops", {})
+    )
+
+
+async def qid_query_enwiki_title(qids: list[str]) -> dict[str, str]:
+    """
+    input a batch, queried in one request per batch_size qids
+    returns: qid -> current title of its english wikipedia article, for the qids that have one
+    """
+    res = {}
+    for i in range(0, len(qids), batch_size):
+        content = await get(qid_query_enwiki_title_url % "|".join(qids[i : i + batch_size]))
+        for qid, entity in content.get("entities", {}).items():
+            if "enwiki" in entity.get("sitelinks", {}):
+                res[qid] = entity["sitelinks"]["enwiki"]["title"]
+    return res
+
+
+async def entity_name_query_image_label_brief(
+    qids: list[str], entity_names: list[str]
+) -> dict[str, dict]:
+    """
+    input a batch, queried in one request per batch_size entities plus continuations;
+    redirects are followed by the API, titles missing since the dump was taken (moved pages)
+    are looked up again by qid on wikidata
+    returns: qid -> page info (images, extract) for the qids that resolve to an article
+    """
+    pages = await query_titles(entity_name_query_image_label_brief_url, entity_names)
+    res = {qid: pages.get(entity, {"missing": ""}) for qid, entity in zip(qids, entity_names)}
+    missing = [qid for qid, page in res.items() if "missing" in page or "invalid" in page]
+    if missing:
+        qid2entity = dict(zip(qids, entity_names))
+        moved = {
+            qid: title
+            for qid, title in (await qid_query_enwiki_title(missing)).items()
+            if title != qid2entity[qid]
+        }
+        moved_pages = await query_titles(
+            entity_name_query_image_label_brief_url, sorted(set(moved.values()))
+        )
+        for qid, title in moved.items():
+            if title in moved_pages:
+                res[qid] = moved_pages[title]
+    return {qid: page for qid, page in res.items() if page_resolved(page)}
+
+
+async def image_label_query_image(labels: list[str]) -> dict[str, dict]:
+    """
+    input a batch, queried in one request per batch_size labels
+    returns: image label -> imageinfo (url, size, mime, thumburl...), for the labels that are images
+    """
+    pages = await query_titles(image_label_query_image_url % ("%s", image_thumb_width), labels)
+    res = {}
+    for label, image in pages.items():
         # if not an image, reject
-        if extension_name in pixel_image_extension_names:
-            url = assign_resolution(url, image_default_width)
-            res.append(url)
-        elif extension_name in vector_image_extension_names:
-            res.append(url)
+        if "imageinfo" in image and image["imageinfo"][0].get("mime") in image_mime_types:
+            res[label] = image["imageinfo"][0]
     return res
 
 
-def download_image(url: str, fileid: str) -> bool:
-    def _write_file(content, path):
-        with open(path, "wb") as f:
-            f.write(content)
-
-    def _download(url: str, fileid: str, file_size_limit: int) -> bool:
-        response = get(url, stream=True)
-        if response.status_code != 200:
-            return False
-        if file_size_limit == 0:  # unlimited
-            _write_file(
-                response.content,
-                os.path.join(image_download_path, fileid + url[url.rfind(".") :]),
-            )
-            return True
+def image_renditions(image: dict) -> list[str]:
+    """
+    returns: URLs to try in order: the original if small enough, then the thumbnail
+    (for svg, a png rendering)
+    """
+    urls = []
+    if image["size"] <= max_file_size:
+        urls.append(image["url"])
+    if image.get("thumburl", image["url"]) != image["url"]:
+        urls.append(image["thumburl"])
+    return urls
+
+
+async def download_image(image: dict, fileid: str) -> str | None:
+    """
+    returns: path of the downloaded file, None if all renditions failed
+    """
+    for url in image_renditions(image):
+        path = os.path.join(image_download_path, fileid + url[url.rfind(".") :])
         try:
-            file_size = int(response.headers["content-length"])
-        except KeyError:
-            file_size = 0 if allow_unkonwn_file_size else inf
-        if file_size < file_size_limit:
-            _write_file(
-                response.content,
-                os.path.join(image_download_path, fileid + url[url.rfind(".") :]),
-            )
-            return True
-        return False
-
-    if _download(url, fileid, max_file_size):
-        return True
-    for res in image_fallback_width:
-        res_url = assign_resolution(url, res)
-        if _download(res_url, fileid, 0):
-            return True
-    return False
-
-
-def process_batch_qids(
-    qids: list[str], qid2entity: dict[str, str]
-) -> tuple[list[str], list[str]]:
-    # input a batch; please ensure qid is unique
-    failed = []
-    try:
-        entities = [qid2entity[qid] for qid in qids]
-        if enable_download_image:
-            image_labels, briefs = entity_name_query_image_label_brief(entities)
-            image_urls = [image_label_query_image(labels) for labels in image_labels]
-            ok = False
-            for i, urls in enumerate(image_urls):
-                for j, url in enumerate(urls):
-                    if download_image(url, f"{qids[i]}-{j}"):
-                        ok = True
-            if not ok:
-                raise Exception(f"image download all failed for {qids}")
-        else:
-            briefs = [entity_name_query_brief(entity) for entity in entities]
-        return briefs, []
-    except KeyboardInterrupt:
-        exit(1)
-    except KeyError:
-        return [""] * len(qids), []
-    except Exception as e:
-        print(e)
-        return [""] * len(qids), qids
+            with metrics.timer("spider_download_seconds"):
+                ok = await fetcher.download(url, path, max_file_size)
+            if ok:
+                return path
+        except FetchError:
+            pass
+    return None
+
+
+async def store_image(label: str, image: dict) -> str | None:
+    """
+    download the image into the archive unless stored already or being downloaded for another qid
+    returns: the archive member holding it, None if the download failed
+    """
+    member = image_archive.lookup(label)
+    if member is not None:
+        return member
+    if label not in downloading:
+
+        async def _download() -> str | None:
+            fileid = hashlib.md5(label.encode("utf8")).hexdigest()
+            path = await download_image(image, fileid)
+            return None if path is None else image_archive.add(label, path)
+
+        downloading[label] = asyncio.ensure_future(_download())
+        downloading[label].add_done_callback(lambda _: downloading.pop(label))
+    return await asyncio.shield(downloading[label])
+
+
+# (qid, status, brief, image archive members, archive shards) to be recorded in the journal
+Record = Tuple[str, str, str, List[str], str]
+
+
+def failed_records(qids: list[str]) -> list[Record]:
+    return [(qid, progress_journal.failed, "", [], "") for qid in qids]
+
+
+async def query_pages(qids: list[str]) -> tuple[list[tuple[str, str, list[str]]], list[str]]:
+    """
+    stage 1, input a batch of qids with entities; please ensure qid is unique
+    returns: (qid, brief, image labels) for each resolved qid; qids without an article
+    (missing or disambiguation page)
+    """
+    qid2entity, qid2images = QidProcessRes.qid2entity, QidProcessRes.qid2images
+    if not enable_download_image:
+        briefs = await entity_name_query_brief([qid2entity[qid] for qid in qids])
+        return [(qid, brief, []) for qid, brief in zip(qids, briefs)], []
+    image_labels = {
+        qid: ["File:" + name for name in qid2images[qid]] for qid in qids if qid in qid2images
+    }
+    dump_qids = list(image_labels.keys())
+    briefs = dict(zip(dump_qids, await entity_name_query_brief([qid2entity[q] for q in dump_qids])))
+    api_qids = [qid for qid in qids if qid not in image_labels]
+    pages = await entity_name_query_image_label_brief(
+        api_qids, [qid2entity[qid] for qid in api_qids]
+    )
+    for qid, page_info in pages.items():
+        image_labels[qid] = [
+            url_unquote(image["title"].strip()) for image in page_info.get("images", [])
+        ]
+        briefs[qid] = page_brief(page_info)
+    unresolved = [qid for qid in api_qids if qid not in pages]
+    resolved = [(qid, briefs[qid], image_labels[qid]) for qid in qids if qid in image_labels]
+    return resolved, unresolved
+
+
+async def query_images(
+    pages: list[tuple[str, str, list[str]]]
+) -> list[tuple[str, str, list[tuple[str, dict]]]]:
+    """
+    stage 2, input the pages of a batch
+    returns: (qid, brief, ranked candidate images as (label, imageinfo)) for each qid
+    """
+    label2image = await image_label_query_image(
+        sorted({label for _, _, labels in pages for label in labels})
+    )
+    return [
+        (
+            qid,
+            brief,
+            rank_images(
+                QidProcessRes.qid2entity[qid],
+                [(l, label2image[l]) for l in labels if l in label2image],
+                image_ranker,
+            ),
+        )
+        for qid, brief, labels in pages
+    ]
+
+
+async def download_best(qid: str, brief: str, images: list[tuple[str, dict]]) -> Record:
+    """
+    stage 3: store the best images_per_entity images of a qid, falling back to the next candidates
+    """
+    members: list[str] = []
+    for label, image in images:
+        if len(members) == images_per_entity:
+            break
+        member = await store_image(label, image)
+        if member is not None and member not in members:
+            members.append(member)
+    if not members:
+        tqdm.write(f"image download all failed for {qid}")
+        return (qid, progress_journal.failed, "", [], "")
+    archive_shards = dict.fromkeys(image_archive.shard_of(member) for member in members)
+    return (qid, progress_journal.done, brief, members, "|".join(archive_shards))
+
+
+async def run_stage(
+    inbox: asyncio.Queue,
+    outbox: asyncio.Queue,
+    process: Callable[[Any], Awaitable[list]],
+    num_workers: int,
+) -> None:
+    """
+    num_workers take items from inbox until None and put each output of process(item) into outbox,
+    then None once all are done
+    """
+
+    async def _worker() -> None:
+        while (item := await inbox.get()) is not None:
+            for output in await process(item):
+                await outbox.put(output)
+        await inbox.put(None)  # for the other workers
+
+    await asyncio.gather(*[_worker() for _ in range(num_workers)])
+    await outbox.put(None)
+
+
+async def process_all(qids: list[str]) -> None:
+    """
+    get images and briefs for all qids through the pipeline; there is no barrier between batches,
+    a slow qid only holds its download worker. results are recorded in the journal as they finish
+    """
+    qids = [qid for qid in qids if qid not in QidProcessRes.completed_qids]
+    pbar = tqdm(total=len(qids))
+    batches = asyncio.Queue(queue_size)
+    pages = asyncio.Queue(queue_size)
+    images = asyncio.Queue(queue_size * batch_size)
+    results = asyncio.Queue(queue_size * batch_size)
+
+    async def _report(records: list[Record]) -> None:
+        for record in records:
+            await results.put(record)
+
+    async def _feed() -> None:
+        skipped = [qid for qid in qids if qid not in QidProcessRes.qid2entity]
+        await _report([(qid, progress_journal.skipped, "", [], "") for qid in skipped])
+        known = [qid for qid in qids if qid in QidProcessRes.qid2entity]
+        for i in range(0, len(known), batch_size):
+            await batches.put(known[i : i + batch_size])
+        await batches.put(None)
+
+    # each stage reports the qids it fails directly, they go no further
+    async def _query_pages(batch: list[str]) -> list[list[tuple[str, str, list[str]]]]:
+        try:
+            res, unresolved = await query_pages(batch)
+        except Exception as e:
+            tqdm.write(str(e))
+            await _report(failed_records(batch))
+            return []
+        await _report([(qid, progress_journal.unresolved, "", [], "") for qid in unresolved])
+        if not res:
+            return []
+        if not enable_download_image:
+            await _report([(qid, progress_journal.done, brief, [], "") for qid, brief, _ in res])
+            return []
+        return [res]
+
+    async def _query_images(
+        batch: list[tuple[str, str, list[str]]]
+    ) -> list[tuple[str, str, list[tuple[str, dict]]]]:
+        try:
+            return await query_images(batch)
+        except Exception as e:
+            tqdm.write(str(e))
+            await _report(failed_records([qid for qid, _, _ in batch]))
+            return []
+
+    async def _download(item: tuple[str, str, list[tuple[str, dict]]]) -> list[Record]:
+        try:
+            return [await download_best(*item)]
+        except Exception as e:
+            tqdm.write(str(e))
+            return failed_records([item[0]])
+
+    async def _record() -> None:
+        """
+        commit whatever has finished, at most batch_size qids at a time;
+        ends with the last stage, after which no stage reports anything
+        """
+        buffer: list[Record] = []
+        done = False
+        while not done:
+            record = await results.get()
+            if record is None:
+                done = True
+            else:
+                buffer.append(record)
+            if buffer and (len(buffer) >= batch_size or results.empty() or done):
+                journal.record(buffer)
+                for record in buffer:
+                    metrics.inc("spider_qids_total", status=record[1])
+                pbar.update(len(buffer))
+                buffer = []
+
+    await asyncio.gather(
+        _feed(),
+        run_stage(batches, pages, _query_pages, page_query_workers),
+        run_stage(pages, images, _query_images, image_query_workers),
+        run_stage(images, results, _download, download_workers),
+        _record(),
+    )
+    pbar.close()
 
 
 class QidProcessRes:
-    qid2entity = {}
-    completed_qids: set[str] = set()
+    qid2entity: EntityIndex | None = None
+    qid2images: dict[str, list[str]] = {}
+    completed_qids: set[str] = set()  # finished in a previous run
 
     @staticmethod
     def load_qid_entity_dict():
-        map_qids, map_entities = load_entities()
-        for k, v in zip(map_qids, map_entities):
-            QidProcessRes.qid2entity[k] = v
+        QidProcessRes.qid2entity = load_entity_index()
+
+    @staticmethod
+    def load_qid_images_dict(qids: list[str]):
+        """
+        only for the qids of this run, not every entity with an image
+        """
+        for qid, _, _, _, images in load_entity_fields(set(qids)):
+            if images:
+                QidProcessRes.qid2images[qid] = images
 
     @staticmethod
     def get_completed_qids():
-        for filename in os.listdir(image_download_path):
-            QidProcessRes.completed_qids.add(filename.split("-")[0])
+        QidProcessRes.completed_qids = journal.completed()
 
 
-def process_run(inputs: tuple[int, list[list[str]]]) -> tuple[list[str], list[str]]:
-    briefs: list[str] = []
-    failed: list[str] = []
-    for qid in tqdm(inputs[1], total=len(inputs[1]), position=inputs[0]):
-        res = process_batch_qids(qid, QidProcessRes.qid2entity)
-        briefs += res[0]
-        failed += res[1]
-    return briefs, failed
+async def process_batches(qids: list[str], batch_list: list[int]) -> None:
+    global fetcher, api_cache
+    if use_api_cache:
+        api_cache = ResponseCache(api_cache_path, api_cache_ttl, api_cache_max_size)
+    selected = [
+        qid
+        for batch in batch_list
+        for qid in qids[batch * checkpoint_interval : (batch + 1) * checkpoint_interval]
+    ]
+    async with Fetcher(head, proxy, host_concurrency, retries=max_retries) as fetcher:
+        await process_all(selected)
+    if api_cache is not None:
+        print(f"API cache: {api_cache.stats()}")
+        api_cache.close()
 
 
-def process_all(qids: list[str]) -> tuple[list[str], list[str]]:
+def use_shard_paths() -> dict[str, str]:
     """
-    get images and briefs for all qids.
-    return : briefs
+    give the files of this run a shard suffix
+    returns: the unsharded paths of the outputs, by role in the manifest
     """
-    qids = list(filter(lambda qid: qid not in QidProcessRes.completed_qids, qids))
-    l = len(qids)
-    batched_qids = [
-        qids[batch_size * i : batch_size * (i + 1)]
-        for i in range((l + batch_size - 1) // batch_size)
+    global api_cache_path, image_download_path, journal_path, zip_store_dir
+    global output_qid_brief_path, failed_qid_file_path
+    merged = {
+        "journal": journal_path,
+        "archive": zip_store_dir,
+        "briefs": output_qid_brief_path,
+        "failed": failed_qid_file_path,
+    }
+    api_cache_path = shards.shard_path(api_cache_path, shard)
+    image_download_path = shards.shard_path(image_download_path, shard)
+    journal_path = shards.shard_path(journal_path, shard)
+    zip_store_dir = shards.shard_path(zip_store_dir, shard)
+    output_qid_brief_path = shards.shard_path(output_qid_brief_path, shard)
+    failed_qid_file_path = shards.shard_path(failed_qid_file_path, shard)
+    return merged
+
+
+def write_manifest(merged: dict[str, str], counts: dict[str, int], failed: list[str]) -> None:
+    outputs = {
+        "journal": (journal_path, merged["journal"]),
+        "archive": (zip_store_dir, merged["archive"]),
+        "briefs": (output_qid_brief_path, merged["briefs"]),
+        "failed": (failed_qid_file_path, merged["failed"]),
+    }
+    archive_files = [
+        os.path.join(zip_store_dir, name)
+        for name in sorted(os.listdir(zip_store_dir))
+        if name.endswith(".tar") or name == "index.sqlite"
     ]
-    l = len(batched_qids)
-    num_pre_thread = (l + num_thread - 1) // num_thread
-    process_args = list(
-        zip(
-            list(range(1, num_thread + 1)),
-            [
-                batched_qids[i * num_pre_thread : (i + 1) * num_pre_thread]
-                for i in range(num_thread)
-            ],
-        )
-    )
-    with Pool(num_thread) as pool:
-        outputs = pool.map(process_run, process_args)
-    return reduce(lambda x, y: (x[0] + y[0], x[1] + y[1]), outputs, ([], []))
+    files = [journal_path, output_qid_brief_path, failed_qid_file_path] + archive_files
+    shards.write_manifest("spider", shard, outputs, files, counts, failed)
 
 
 def main():
+    global journal, image_archive, shard
+    shard = shards.parse_shard_arg(sys.argv)
+    merged = use_shard_paths() if shard is not None else {}
+    metrics.start()
     Path(image_download_path).mkdir(exist_ok=True)
-    Path(zip_store_dir).mkdir(exist_ok=True)
-    QidProcessRes.load_qid_entity_dict()
-    QidProcessRes.get_completed_qids()
+    journal = ProgressJournal(journal_path)
+    image_archive = ImageArchive(zip_store_dir, image_shard_size)
     with open(qid_file_path, "r") as f:
         qids = [line.strip() for line in f.readlines() if line != "" and line != "\n"]
+    qids = [qid for qid in qids if shards.in_shard(qid, shard)]
+    QidProcessRes.load_qid_entity_dict()
+    if use_dump_images:
+        QidProcessRes.load_qid_images_dict(qids)
+    QidProcessRes.get_completed_qids()
     batch_size = checkpoint_interval
     num_batches = (len(qids) + batch_size - 1) // batch_size
     if len(sys.argv) > 2:
@@ -347,24 +649,14 @@ def main():
             raise ValueError("params error.")
     else:
         batch_list = list(range(num_batches))
-    qid2brief = {}
-    fails = []
-    for i, batch in tqdm(enumerate(batch_list), total=len(batch_list)):
-        print(f"process batch {batch} ({i} / {len(batch_list)}) with size {batch_size}")
-        batch_qids = qids[
-            batch * checkpoint_interval : (batch + 1) * checkpoint_interval
-        ]
-        briefs, fail = process_all(batch_qids)
-        for qid, brief in zip(batch_qids, briefs):
-            if brief:
-                qid2brief[qid] = brief
-        fails += fail
-        if enable_download_image and loop_callback(batch):
-            print(f"Error storing file on batch {batch}!")
-    with open(output_qid_brief_path, "w") as f:
-        json.dump(qid2brief, f)
-    with open(failed_qid_file_path, "w") as f:
-        f.write('\n'.join(fails))
+    asyncio.run(process_batches(qids, batch_list))
+    journal.export(output_qid_brief_path, failed_qid_file_path)
+    counts, failed = journal.counts(), journal.failed_qids()
+    journal.close()
+    image_archive.close()
+    if shard is not None:  # once the databases are closed and complete on disk
+        write_manifest(merged, counts, failed)
+    metrics.stop()
 
 
 if __name__ == "__main__":
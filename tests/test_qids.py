@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Regression checks of qid file reading; run with python -m pytest tests
+"""
+
+from __future__ import annotations
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import qids
+
+
+def test_read_text_line_across_read_boundary(tmp_path):
+    """
+    the last qid crosses the first read boundary, with no trailing newline
+    (as candidates.py writes all-qids.txt)
+    """
+    lines, size = [], 0
+    while size + len(f"Q{len(lines) + 1}\n") < qids.block_size * 8 - 3:
+        lines.append(f"Q{len(lines) + 1}")
+        size += len(lines[-1]) + 1
+    lines.append("Q9999999")
+    path = tmp_path / "qids.txt"
+    path.write_text("\n".join(lines))
+    assert path.stat().st_size > qids.block_size * 8
+    expected = np.array(sorted(int(line[1:]) for line in lines), dtype=np.uint32)
+    assert np.array_equal(np.concatenate(list(qids.read_qids(str(path)))), expected)
+
+
+def test_read_text_line_spanning_reads(tmp_path, monkeypatch):
+    """
+    reads without any line break in them carry over to the next
+    """
+    monkeypatch.setattr(qids, "block_size", 1)  # 8 characters per read
+    path = tmp_path / "qids.txt"
+    path.write_text("Q123456789\nQ1\nQ3000000000")
+    assert list(np.concatenate(list(qids.read_qids(str(path))))) == [1, 123456789, 3000000000]